@@ -1,10 +1,14 @@
+import functools
 import time
-import logging
 import numpy as np
-from math import log, gcd
+from math import gcd
 import sys
-from sympy import Poly, symbols
+import codec
+import compact
+import keyfile
+import metrics
 from utils import *
+from ring import context, cyclic_mul, circulant, circulant_mul, sparse_mul, ternary_indices, linear_mul, fold, center_lift, to_ring
 
 
 class NTRUdecrypt:
@@ -40,17 +44,22 @@ class NTRUdecrypt:
         self.debug = debug
         self.check_time = check_time
 
-        self.f = np.zeros((self.N,), dtype=int)
-        self.fp = np.zeros((self.N,), dtype=int)
-        self.fq = np.zeros((self.N,), dtype=int)
-        self.g = np.zeros((self.N,), dtype=int)
-        self.h = np.zeros((self.N,), dtype=int)
+        # Polynomials are stored in compact integer types (see compact.py)
+        self.f = np.zeros((self.N,), dtype=np.int8)
+        self.fp = np.zeros((self.N,), dtype=np.int8)
+        self.fq = np.zeros((self.N,), dtype=np.int8)
+        self.g = np.zeros((self.N,), dtype=np.int8)
+        self.h = np.zeros((self.N,), dtype=np.int8)
 
-        self.I = np.zeros((self.N + 1,), dtype=int)
-        self.I[self.N] = -1
-        self.I[0] = 1
+        # Shared parameters of the ring, including the ideal as array representing polynomial
+        self.ctx = context(self.N, self.p, self.q)
 
         self.M = None
+        self.Mbytes = None
+
+        # Tables derived from the private key (e.g. the sparse form of f), built on first use
+        # or by precompute(). Shallow copies of an instance share them.
+        self.tables = {}
 
         self.logger = logger
 
@@ -59,21 +68,28 @@ class NTRUdecrypt:
                 N, p, q, df, dg, d))
 
     @staticmethod
-    def time_function(func):
+    def time_function(name):
         """
-        Decorator to time functions and log if check_time is True.
+        Decorator recording the duration of a method under the metric name (see metrics.py),
+        and logging it if check_time is True.
         """
-        def wrapper(self, *args, **kwargs):
-            if self.check_time:
-                start_time = time.time()
-            result = func(self, *args, **kwargs)
-            if self.check_time:
-                end_time = time.time()
-                self.logger.time("Function '{}' executed in {:.6f} seconds".format(func.__name__, end_time - start_time))
-            return result
-        return wrapper
-
-    @time_function
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(self, *args, **kwargs):
+                if not (self.check_time or metrics.registry.enabled):
+                    return func(self, *args, **kwargs)
+                start_time = time.perf_counter_ns()
+                try:
+                    return func(self, *args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter_ns() - start_time
+                    metrics.observe(name, elapsed)
+                    if self.check_time:
+                        self.logger.time("Function '{}' executed in {:.6f} seconds".format(func.__name__, elapsed / 1e9))
+            return wrapper
+        return decorator
+
+    @time_function("keygen.set_params")
     def setNpq(self, N=None, p=None, q=None, df=None, dg=None, d=None):
         """
         Set the N, p and q values and perform checks on their validity.
@@ -120,43 +136,71 @@ class NTRUdecrypt:
             else:
                 self.dr = d
 
+        self.ctx = context(self.N, self.p, self.q)
+
         if self.debug:
             self.logger.debug("setNpq called with parameters: N={}, p={}, q={}, df={}, dg={}, d={}".format(
                 self.N, self.p, self.q, self.df, self.dg, self.dr))
 
     def reset_polynomials(self):
         """ Reset polynomial arrays after changing N """
-        self.f = np.zeros((self.N,), dtype=int)
-        self.fp = np.zeros((self.N,), dtype=int)
-        self.fq = np.zeros((self.N,), dtype=int)
-        self.g = np.zeros((self.N,), dtype=int)
-        self.h = np.zeros((self.N,), dtype=int)
-        self.I = np.zeros((self.N + 1,), dtype=int)
-        self.I[self.N] = -1
-        self.I[0] = 1
-
-    @time_function
+        self.f = np.zeros((self.N,), dtype=np.int8)
+        self.fp = np.zeros((self.N,), dtype=np.int8)
+        self.fq = np.zeros((self.N,), dtype=np.int8)
+        self.g = np.zeros((self.N,), dtype=np.int8)
+        self.h = np.zeros((self.N,), dtype=np.int8)
+        self.tables = {}
+        self.ctx = context(self.N, self.p, self.q)
+
+    @property
+    def I(self):
+        """ The ring ideal x^N - 1 as array (shared, read-only) """
+        return self.ctx.I
+
+    def precompute(self):
+        """
+        Build all tables derived from the private key up front, rather than on first use.
+        """
+        for name in ("f_idx", "f", "fp"):
+            self.table(name)
+
+    def table(self, name):
+        """
+        Return a table derived from the private key:
+            "f_idx" : the sparse form of f (see ring.ternary_indices)
+            "f"     : the circulant matrix of f, applied to ciphertext blocks
+            "fp"    : the circulant matrix of fp, applied to ternary blocks
+        """
+        if name not in self.tables:
+            if name == "f_idx":
+                self.tables[name] = ternary_indices(to_ring(self.f, self.N))
+            elif name == "f":
+                self.tables[name] = circulant(self.f, self.N, amax=self.q // 2)
+            elif name == "fp":
+                self.tables[name] = circulant(self.fp, self.N, amax=self.p // 2)
+            else:
+                raise KeyError(name)
+        return self.tables[name]
+
+    @time_function("keygen.invf")
     def invf(self):
         """
         Invert the f polynomial with respect to input p and q values.
         Return True if inverses w.r.t. p and q exist (after setting self.fp and self.fq).
         Return False if inverse w.r.t. either/or p/q does not exist.
         """
-        fp_tmp = poly_inv(self.f, self.I, self.p)
-        fq_tmp = poly_inv(self.f, self.I, self.q)
+        fp_tmp = poly_inv(self.f, self.I, self.p, self.ctx)
+        fq_tmp = poly_inv(self.f, self.I, self.q, self.ctx)
 
         if len(fp_tmp) > 0 and len(fq_tmp) > 0:
-            self.fp = np.array(fp_tmp)
-            self.fq = np.array(fq_tmp)
-            if len(self.fp) < self.N:
-                self.fp = np.concatenate([np.zeros(self.N - len(self.fp), dtype=int), self.fp])
-            if len(self.fq) < self.N:
-                self.fq = np.concatenate([np.zeros(self.N - len(self.fq), dtype=int), self.fq])
+            # Residues mod p (int8) and mod q (uint16 for the usual q), padded to N coefficients
+            self.fp = compact.residues(to_ring(fp_tmp, self.N), self.p)
+            self.fq = compact.residues(to_ring(fq_tmp, self.N), self.q)
             return True
         else:
             return False
 
-    @time_function
+    @time_function("keygen.genfg")
     def genfg(self):
         """
         Randomly generate f and g for the private key and their inverses.
@@ -166,6 +210,7 @@ class NTRUdecrypt:
 
         for i in range(maxTries):
             self.f = genRand10(self.N, self.df, self.df - 1)
+            self.tables = {}
 
             invStat = self.invf()
             if invStat:
@@ -173,114 +218,167 @@ class NTRUdecrypt:
             elif i == maxTries - 1:
                 sys.exit("Cannot generate required inverses of f")
 
-    @time_function
+    @time_function("keygen.genh")
     def genh(self):
         """
         Generate the public key from the class values (that must have been generated previously).
         """
-        x = symbols('x')
         while True:
-            self.h = Poly((Poly(self.p * self.fq, x).trunc(self.q) * Poly(self.g, x)).trunc(self.q) \
-                          % Poly(self.I, x)).all_coeffs()
+            # The product is centered mod q before (not after) reducing by x^N - 1, which
+            # keeps h identical to the keys written by earlier versions (so h lies in (-q, q])
+            pfq = center_lift(self.p * to_ring(self.fq, self.N), self.q)
+            self.h = compact.narrow(fold(center_lift(linear_mul(pfq, self.g), self.q), self.N))
 
-            if len(factor_int(self.h[-1])) == 0:
+            if len(factor_int(int(self.h[-1]))) == 0:
                 break
             self.genfg()
 
-    @time_function
-    def writePub(self, filename="key"):
+    @time_function("key_io.write_pub")
+    def writePub(self, filename="key", binary=False):
         """
-        Write the public key file.
+        Write the public key file, in the binary key format (see keyfile.py) if binary is True.
         """
-        pubHead = "p ::: " + str(self.p) + "\nq ::: " + str(self.q) + "\nN ::: " + str(self.N) \
-                  + "\nd ::: " + str(self.dr) + "\nh :::"
-        np.savetxt(filename + ".pub", self.h, newline=" ", header=pubHead, fmt="%s")
+        if binary:
+            keyfile.write_key(filename + ".pub", keyfile.PUBLIC, self.params(), (self.h,))
+        else:
+            pubHead = "p ::: " + str(self.p) + "\nq ::: " + str(self.q) + "\nN ::: " + str(self.N) \
+                      + "\nd ::: " + str(self.dr) + "\nh :::"
+            np.savetxt(filename + ".pub", self.h, newline=" ", header=pubHead, fmt="%s")
+            keyfile.written(filename + ".pub")
 
-    @time_function
+    @time_function("key_io.read_pub")
     def readPub(self, filename="key.pub"):
         """
-        Read a public key file.
+        Read a public key file, either in the text or in the binary key format.
         """
-        with open(filename, "r") as f:
-            self.p = int(f.readline().split(" ")[-1])
-            self.q = int(f.readline().split(" ")[-1])
-            self.N = int(f.readline().split(" ")[-1])
-            self.dr = int(f.readline().split(" ")[-1])
-            self.h = np.array(f.readline().split(" ")[3:-1], dtype=int)
-        self.I = np.zeros((self.N + 1,), dtype=int)
-        self.I[self.N] = -1
-        self.I[0] = 1
-
-    @time_function
-    def writePriv(self, filename="key"):
+        if keyfile.is_binary(filename):
+            kind, params, arrays = keyfile.read_key(filename)
+            if kind not in (keyfile.PUBLIC, keyfile.PAIR):
+                raise ValueError("{} is not a public key file".format(filename))
+            self.p, self.q, self.N, self.dr = params["p"], params["q"], params["N"], params["d"]
+            self.h = arrays[0]
+        else:
+            with open(filename, "r") as f:
+                self.p = int(f.readline().split(" ")[-1])
+                self.q = int(f.readline().split(" ")[-1])
+                self.N = int(f.readline().split(" ")[-1])
+                self.dr = int(f.readline().split(" ")[-1])
+                self.h = compact.narrow(np.array(f.readline().split(" ")[3:-1], dtype=int))
+        self.ctx = context(self.N, self.p, self.q)
+
+    @time_function("key_io.write_priv")
+    def writePriv(self, filename="key", binary=False):
         """
-        Write the private key file.
+        Write the private key file, in the binary key format (see keyfile.py) if binary is True.
         """
-        privHead = "p ::: " + str(self.p) + "\nq ::: " + str(self.q) + "\nN ::: " \
-                   + str(self.N) + "\ndf ::: " + str(self.df) + "\ndg ::: " + str(self.dg) \
-                   + "\nd ::: " + str(self.dr) + "\nf/fp/fq/g :::"
-        np.savetxt(filename + ".priv", (self.f, self.fp, self.fq, self.g), header=privHead, newline="\n", fmt="%s")
-
-    @time_function
+        if binary:
+            keyfile.write_key(filename + ".priv", keyfile.PRIVATE, self.params(),
+                              (self.f, self.fp, self.fq, self.g))
+        else:
+            privHead = "p ::: " + str(self.p) + "\nq ::: " + str(self.q) + "\nN ::: " \
+                       + str(self.N) + "\ndf ::: " + str(self.df) + "\ndg ::: " + str(self.dg) \
+                       + "\nd ::: " + str(self.dr) + "\nf/fp/fq/g :::"
+            np.savetxt(filename + ".priv", (self.f, self.fp, self.fq, self.g), header=privHead, newline="\n",
+                       fmt="%s")
+            keyfile.written(filename + ".priv")
+
+    @time_function("key_io.read_priv")
     def readPriv(self, filename="key.priv"):
         """
-        Read a public key file.
-        """
-        with open(filename, "r") as f:
-            self.p = int(f.readline().split(" ")[-1])
-            self.q = int(f.readline().split(" ")[-1])
-            self.N = int(f.readline().split(" ")[-1])
-            self.df = int(f.readline().split(" ")[-1])
-            self.dg = int(f.readline().split(" ")[-1])
-            self.dr = int(f.readline().split(" ")[-1])
-            tmp = f.readline()
-            self.f = np.array(f.readline().split(" "), dtype=int)
-            self.fp = np.array(f.readline().split(" "), dtype=int)
-            self.fq = np.array(f.readline().split(" "), dtype=int)
-            self.g = np.array(f.readline().split(" "), dtype=int)
-        self.I = np.zeros((self.N + 1,), dtype=int)
-        self.I[self.N] = -1
-        self.I[0] = 1
-
-    @time_function
-    def genPubPriv(self, keyfileName="key"):
+        Read a private key file, either in the text or in the binary key format.
+        """
+        if keyfile.is_binary(filename):
+            kind, params, arrays = keyfile.read_key(filename)
+            if kind == keyfile.PAIR:
+                # Key pair records (see keystore.py) hold h in front of the private key
+                arrays = arrays[1:]
+            elif kind != keyfile.PRIVATE:
+                raise ValueError("{} is not a private key file".format(filename))
+            self.p, self.q, self.N = params["p"], params["q"], params["N"]
+            self.df, self.dg, self.dr = params["df"], params["dg"], params["d"]
+            self.f, self.fp, self.fq, self.g = arrays
+        else:
+            with open(filename, "r") as f:
+                self.p = int(f.readline().split(" ")[-1])
+                self.q = int(f.readline().split(" ")[-1])
+                self.N = int(f.readline().split(" ")[-1])
+                self.df = int(f.readline().split(" ")[-1])
+                self.dg = int(f.readline().split(" ")[-1])
+                self.dr = int(f.readline().split(" ")[-1])
+                tmp = f.readline()
+                self.f = compact.ternary(np.array(f.readline().split(" "), dtype=int))
+                self.fp = compact.residues(np.array(f.readline().split(" "), dtype=int), self.p)
+                self.fq = compact.residues(np.array(f.readline().split(" "), dtype=int), self.q)
+                self.g = compact.ternary(np.array(f.readline().split(" "), dtype=int))
+        self.tables = {}
+        self.ctx = context(self.N, self.p, self.q)
+
+    def params(self):
+        """
+        Return the key parameters as a dictionary (as stored in the key files).
+        """
+        return {"N": self.N, "p": self.p, "q": self.q, "df": self.df, "dg": self.dg, "d": self.dr}
+
+    @time_function("keygen.total")
+    def genPubPriv(self, keyfileName="key", binary=False):
         """
         Generate the public and private keys from class N, p and q values.
         Also write output files for the public and private keys.
         """
         self.genfg()
         self.genh()
-        self.writePub(keyfileName)
-        self.writePriv(keyfileName)
+        self.writePub(keyfileName, binary)
+        self.writePriv(keyfileName, binary)
 
-    @time_function
+    @time_function("decrypt.block")
     def decrypt(self, e):
         """
         Decrypt the message given as an input array e into the decrypted message m and return.
         """
         if len(e) > self.N:
             sys.exit("Encrypted message has degree > N")
-        x = symbols('x')
-        a = ((Poly(self.f, x) * Poly(e, x)) % Poly(self.I, x)).trunc(self.q)
-        b = a.trunc(self.p)
-        c = ((Poly(self.fp, x) * b) % Poly(self.I, x)).trunc(self.p)
+        a = center_lift(sparse_mul(*self.table("f_idx"), e, self.N), self.q)
+        b = center_lift(a, self.p)
+        c = compact.centered(cyclic_mul(self.fp, b, self.N), self.p)
 
-        return np.array(c.all_coeffs(), dtype=int)
+        return c
 
-    @time_function
-    def decryptString(self, E):
+    @time_function("decrypt.blocks")
+    def decryptBlocks(self, E):
+        """
+        Decrypt a matrix of encrypted blocks, one block of N coefficients per row, and return
+        the decrypted message blocks as an integer array of the same shape.
+        """
+        E = np.asarray(E)
+        if E.ndim != 2 or E.shape[1] != self.N:
+            sys.exit("ERROR : Encrypted blocks must be given as a (blocks, N) array")
+        metrics.inc("decrypt.block_count", E.shape[0])
+        # Same steps as decrypt, but every product covers all blocks at once. Centering E
+        # first keeps its coefficients within the bound the table of f was built for.
+        A = center_lift(circulant_mul(center_lift(E, self.q), self.table("f")), self.q)
+        B = center_lift(A, self.p)
+        return compact.centered(circulant_mul(B, self.table("fp")), self.p)
+
+    @time_function("decrypt.string")
+    def decryptString(self, E, workers=1):
         """
         Decrypt a message encoded using the requisite public key from an encoded to a decoded string.
+        The decrypted message is saved as bytes in self.Mbytes and decoded as UTF-8 in self.M.
+        With workers > 1 the blocks are decrypted by that many processes (see parallel.py).
+        Raise ValueError if E is not a valid ciphertext for this key.
         """
-        Me = np.fromstring(E, dtype=int, sep=' ')
-        if np.mod(len(Me), self.N) != 0:
-            sys.exit("\n\nERROR : Input decrypt string is not integer multiple of N\n\n")
-
-        Marr = np.array([], dtype=int)
-        for D in range(len(Me) // self.N):
-            Marr = np.concatenate((Marr, padArr(self.decrypt(Me[D * self.N:(D + 1) * self.N]), self.N)))
+        if workers > 1:
+            # The workers parse their own part of the string (see parallel.py)
+            from parallel import decrypt_text
+            Marr = decrypt_text(self, E, workers)
+        else:
+            Me = np.fromstring(E, dtype=int, sep=' ')
+            if np.mod(len(Me), self.N) != 0:
+                raise ValueError("Input decrypt string is not integer multiple of N")
+            Marr = self.decryptBlocks(Me.reshape(-1, self.N))
 
-        self.M = bit2str(Marr)
+        self.Mbytes = codec.decode_message(Marr)
+        self.M = self.Mbytes.decode("utf-8", errors="ignore")
 
         if self.debug:
-            self.logger.debug("Decrypted string: {}".format(self.M))
+            self.logger.debug("Decrypted %d bytes", len(self.Mbytes))
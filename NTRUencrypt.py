@@ -1,7 +1,12 @@
 import numpy as np
 import sys
-from sympy import Poly, symbols
+import codec
+import compact
+import keyfile
+import metrics
+import sampler
 from utils import *
+from ring import context, cyclic_mul, circulant, circulant_mul, to_ring
 
 
 class NTRUencrypt:
@@ -19,44 +24,78 @@ class NTRUencrypt:
 
         self.dr = d  # Number of 1's in r (for encryption)
 
-        self.g = np.zeros((self.N,), dtype=int)  # Private polynomial g
-        self.h = np.zeros((self.N,), dtype=int)  # Public key polynomial (mod q)
-        self.r = np.zeros((self.N,), dtype=int)  # A random `blinding value'
-        self.genr()
-        self.m = np.zeros((self.N,), dtype=int)  # The message array
-        self.e = np.zeros((self.N,), dtype=int)  # The encrypted message
+        # Polynomials are stored in compact integer types (see compact.py)
+        self.g = np.zeros((self.N,), dtype=np.int8)  # Private polynomial g
+        self.h = np.zeros((self.N,), dtype=np.int8)  # Public key polynomial (mod q)
+        self.r = None  # A random `blinding value' (packed ternary), drawn by genr (on first use)
+        self.m = np.zeros((self.N,), dtype=np.int8)  # The message array
+        self.e = np.zeros((self.N,), dtype=np.int8)  # The encrypted message
 
-        # Ideal as array representing polynomial
-        self.I = np.zeros((self.N + 1,), dtype=int)
-        self.I[self.N] = -1
-        self.I[0] = 1
+        # Shared parameters of the ring, including the ideal as array representing polynomial
+        self.ctx = context(self.N, self.p, self.q)
 
         self.readKey = False  # We have not yet read the public key file
 
+        # Tables derived from the public key (e.g. the circulant matrix of h), built on first
+        # use or by precompute(). Shallow copies of an instance share them.
+        self.tables = {}
+
         # Variables to save any possible encrypted messages (if req)
         self.Me = None  # The encrypted message as a string
 
+    @metrics.timed("key_io.read_pub")
     def readPub(self, filename="key.pub"):
         """
-        Read a public key file, generate a new r value based on new N
-        """
-        with open(filename, "r") as f:
-            self.p = int(f.readline().split(" ")[-1])
-            self.q = int(f.readline().split(" ")[-1])
-            self.N = int(f.readline().split(" ")[-1])
-            self.dr = int(f.readline().split(" ")[-1])
-            self.h = np.array(f.readline().split(" ")[3:-1], dtype=int)
-        self.I = np.zeros((self.N + 1,), dtype=int)
-        self.I[self.N] = -1
-        self.I[0] = 1
-        self.genr()
+        Read a public key file (text or binary key format), a new r value based on the new N is
+        drawn on the next encrypt
+        """
+        if keyfile.is_binary(filename):
+            kind, params, arrays = keyfile.read_key(filename)
+            if kind not in (keyfile.PUBLIC, keyfile.PAIR):
+                raise ValueError("{} is not a public key file".format(filename))
+            self.p, self.q, self.N, self.dr = params["p"], params["q"], params["N"], params["d"]
+            self.h = arrays[0]
+        else:
+            with open(filename, "r") as f:
+                self.p = int(f.readline().split(" ")[-1])
+                self.q = int(f.readline().split(" ")[-1])
+                self.N = int(f.readline().split(" ")[-1])
+                self.dr = int(f.readline().split(" ")[-1])
+                self.h = compact.narrow(np.array(f.readline().split(" ")[3:-1], dtype=int))
+        self.tables = {}
+        self.ctx = context(self.N, self.p, self.q)
+        self.r = None
         self.readKey = True
 
+    @property
+    def I(self):
+        """ The ring ideal x^N - 1 as array (shared, read-only) """
+        return self.ctx.I
+
+    def precompute(self):
+        """
+        Build all tables derived from the public key up front, rather than on first use.
+        """
+        self.table("h")
+
+    def table(self, name):
+        """
+        Return a table derived from the public key:
+            "h" : the circulant matrix of h, applied to (ternary) blinding polynomials
+        """
+        if name not in self.tables:
+            if name == "h":
+                self.tables[name] = circulant(self.h, self.N, amax=1)
+            else:
+                raise KeyError(name)
+        return self.tables[name]
+
     def genr(self):
         """
-        Generate the random binding polynomial array r, with values mod q
+        Generate the random binding polynomial array r, with values mod q, kept packed to 2 bits
+        per coefficient (see compact.PackedTernary)
         """
-        self.r = genRand10(self.N, self.dr, self.dr)
+        self.r = compact.pack_ternary(genRand10(self.N, self.dr, self.dr))
 
     def setM(self, M):
         """
@@ -71,12 +110,12 @@ class NTRUencrypt:
             sys.exit("ERROR : Public key not read before setting message")
         if len(M) > self.N:
             sys.exit("ERROR : Message length longer than degree of polynomial ring ideal")
-        for i in range(len(M)):
-            if M[i] < -self.p / 2 or M[i] > self.p / 2:
-                sys.exit("ERROR : Elements of message must be in [-p/2,p/2]")
+        if np.any(np.abs(M) > self.p / 2):
+            sys.exit("ERROR : Elements of message must be in [-p/2,p/2]")
         # Passed the error checks, so now save the class message function, inc leading zeros
         self.m = padArr(M, self.N)
 
+    @metrics.timed("encrypt.block")
     def encrypt(self, m=None):
         """
         Encrypt the message m into the array e
@@ -90,15 +129,43 @@ class NTRUencrypt:
             if len(m) > self.N:
                 sys.exit("\n\nERROR: Polynomial message of degree >= N")
             self.m = m
-        x = symbols('x')
+        if self.r is None:
+            self.genr()
         # Actually perform the encryption, set the class variable
-        self.e = np.array(((((Poly(self.r, x) * Poly(self.h, x)).trunc(self.q))
-                            + Poly(self.m, x)) % Poly(self.I, x)).trunc(self.q).all_coeffs(), dtype=int)
-        self.e = padArr(self.e, self.N)
+        self.e = compact.centered(cyclic_mul(self.r, self.h, self.N) + to_ring(self.m, self.N), self.q)
 
-    def encryptString(self, M):
+    @metrics.timed("encrypt.blocks")
+    def encryptBlocks(self, B, rng=None):
         """
-        Encrypt the input string M by first converting to binary
+        Encrypt a matrix of message blocks, one block of N coefficients per row, with a
+        separate random blinding polynomial for each block.
+        Return the encrypted blocks as an integer array of the same shape.
+
+        The blinding polynomials are drawn from rng (any random source accepted by
+        sampler.ternary), or from the global numpy random state if rng is None.
+
+        NOTE : The coefficients must be in [-p/2,p/2].
+        """
+        if not self.readKey:
+            sys.exit("Error : Not read the public key file, so cannot encrypt")
+        B = np.asarray(B)
+        if B.ndim != 2 or B.shape[1] != self.N:
+            sys.exit("ERROR : Message blocks must be given as a (blocks, N) array")
+        if np.any(np.abs(B) > self.p / 2):
+            sys.exit("ERROR : Elements of message must be in [-p/2,p/2]")
+
+        metrics.inc("encrypt.block_count", B.shape[0])
+        # Draw all blinding polynomials at once and compute every r*h + m in one pass
+        R = sampler.ternary(B.shape[0], self.N, self.dr, self.dr, rng)
+        return compact.centered(circulant_mul(R, self.table("h")) + B, self.q)
+
+    @metrics.timed("encrypt.string")
+    def encryptString(self, M, workers=1, encoding=codec.ENCODING_BITS):
+        """
+        Encrypt the input string M (or bytes) by first converting to binary (or with
+        encoding=codec.ENCODING_TERNARY to balanced ternary digits, about 37% fewer blocks),
+        see codec.encode_message for the framing used.
+        With workers > 1 the blocks are encrypted by that many processes (see parallel.py).
 
         NOTE : The public key must have been read before running this routine
         """
@@ -106,18 +173,16 @@ class NTRUencrypt:
         # We have to have read the public key before starting
         if not self.readKey:
             sys.exit("Error : Not read the public key file, so cannot encrypt")
-
-        # Create a binary array of the input string, and pad it with leading zeros
-        # such that its length is a multiple of N
-        bM = str2bit(M)
-        bM = padArr(bM, len(bM) - np.mod(len(bM), self.N) + self.N)
-
-        # We then need an empty string to save the encrypted message to
-        self.Me = ""
-
-        # And loop through encrypting each message block (of length N) with different random polynomial
-        for E in range(len(bM) // self.N):
-            self.genr()  # Gen random obfuscating polynomial
-            self.setM(bM[E * self.N:(E + 1) * self.N])  # Set the messsage to encrypt as single block
-            self.encrypt()  # Encrypt the saved message
-            self.Me = self.Me + arr2str(self.e) + " "  # Append encrypted to string
\ No newline at end of file
+        if encoding == codec.ENCODING_TERNARY and self.p < 3:
+            sys.exit("Error : Ternary message encoding needs p >= 3")
+
+        # Create the framed blocks (of length N) of the input string
+        bM = codec.encode_message(M, self.N, encoding)
+
+        # Encrypt all message blocks (of length N), each with a different random polynomial,
+        # and join them into a single string
+        if workers > 1:
+            from parallel import encrypt_text
+            self.Me = encrypt_text(self, bM, workers)
+        else:
+            self.Me = " ".join(map(str, self.encryptBlocks(bM).ravel().tolist()))
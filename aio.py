@@ -0,0 +1,146 @@
+"""
+asyncio facade for the blocking functions in ntru.py.
+
+Every call runs in a concurrent.futures executor (a thread pool by default, any process
+pool works as well), so the event loop stays responsive while keys are generated or
+messages are encrypted. At most max_concurrency calls are handed to the executor at once,
+further callers wait (cancellably) until a slot frees up.
+
+NOTE : Cancelling a call that is still waiting for a slot, or that the executor has not
+       started yet, drops it. A call that is already running cannot be interrupted, its
+       result is discarded once it finishes.
+
+Usage:
+    import ntru
+    enc = await ntru.aio.encrypt("key", "test")
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import ntru
+
+
+class AsyncNTRU:
+    """
+    Awaitable versions of generate_keys, encrypt, decrypt, encrypt_many, decrypt_many,
+    encrypt_bytes and decrypt_bytes, offloaded to an executor with a concurrency limit.
+    """
+
+    def __init__(self, executor=None, max_concurrency=None):
+        """
+        INPUTS:
+        =======
+        executor        : concurrent.futures.Executor the work runs in, a thread pool with
+                          max_concurrency threads is created if None.
+        max_concurrency : Integer, the maximum number of calls submitted to the executor at
+                          once, defaults to the number of CPUs.
+        """
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(self.max_concurrency, thread_name_prefix="ntru-aio")
+        self._semaphore = None
+        self._loop = None
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in the executor once a concurrency slot is free.
+        With a process pool executor func and its arguments must be picklable.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Semaphores belong to a single event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        async with self._semaphore:
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def generate_keys(self, *args, **kwargs):
+        """ Awaitable ntru.generate_keys """
+        return await self.run(ntru.generate_keys, *args, **kwargs)
+
+    async def encrypt(self, *args, **kwargs):
+        """ Awaitable ntru.encrypt """
+        return await self.run(ntru.encrypt, *args, **kwargs)
+
+    async def decrypt(self, *args, **kwargs):
+        """ Awaitable ntru.decrypt """
+        return await self.run(ntru.decrypt, *args, **kwargs)
+
+    async def encrypt_many(self, *args, **kwargs):
+        """ Awaitable ntru.encrypt_many """
+        return await self.run(ntru.encrypt_many, *args, **kwargs)
+
+    async def decrypt_many(self, *args, **kwargs):
+        """ Awaitable ntru.decrypt_many """
+        return await self.run(ntru.decrypt_many, *args, **kwargs)
+
+    async def encrypt_bytes(self, *args, **kwargs):
+        """ Awaitable ntru.encrypt_bytes """
+        return await self.run(ntru.encrypt_bytes, *args, **kwargs)
+
+    async def decrypt_bytes(self, *args, **kwargs):
+        """ Awaitable ntru.decrypt_bytes """
+        return await self.run(ntru.decrypt_bytes, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        """
+        Shut the executor down.
+        """
+        self.executor.shutdown(wait=wait)
+
+
+_default = None
+
+
+def configure(executor=None, max_concurrency=None):
+    """
+    Replace the executor and concurrency limit used by the module level functions.
+    A previous default executor created by this module is shut down (without waiting for
+    running calls), executors passed in by the caller are left alone.
+    """
+    global _default
+    if _default is not None and _default.owns_executor:
+        _default.shutdown(wait=False)
+    _default = AsyncNTRU(executor, max_concurrency)
+    return _default
+
+
+def _get_default():
+    return _default or configure()
+
+
+async def generate_keys(*args, **kwargs):
+    """ Awaitable ntru.generate_keys """
+    return await _get_default().generate_keys(*args, **kwargs)
+
+
+async def encrypt(*args, **kwargs):
+    """ Awaitable ntru.encrypt """
+    return await _get_default().encrypt(*args, **kwargs)
+
+
+async def decrypt(*args, **kwargs):
+    """ Awaitable ntru.decrypt """
+    return await _get_default().decrypt(*args, **kwargs)
+
+
+async def encrypt_many(*args, **kwargs):
+    """ Awaitable ntru.encrypt_many """
+    return await _get_default().encrypt_many(*args, **kwargs)
+
+
+async def decrypt_many(*args, **kwargs):
+    """ Awaitable ntru.decrypt_many """
+    return await _get_default().decrypt_many(*args, **kwargs)
+
+
+async def encrypt_bytes(*args, **kwargs):
+    """ Awaitable ntru.encrypt_bytes """
+    return await _get_default().encrypt_bytes(*args, **kwargs)
+
+
+async def decrypt_bytes(*args, **kwargs):
+    """ Awaitable ntru.decrypt_bytes """
+    return await _get_default().decrypt_bytes(*args, **kwargs)
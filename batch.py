@@ -0,0 +1,185 @@
+"""
+Batched encryption for many recipients at once, and batched decryption of many independent
+ciphertexts under one private key.
+
+The same message blocks are encrypted under many public keys with the same parameters in
+a few vectorised passes. For short messages the public keys are stacked into one matrix,
+and every product r * h (r a sparse ternary blinding polynomial) is the sum of the rows of
+the rotation matrix of h (a zero-copy sliding window view, see ring.sparse_mul) selected by
+the non-zero positions of r, gathered for many (recipient, block) pairs at a time. For
+longer messages, where building the circulant matrix of h pays off, all blocks of a key
+are multiplied in one matrix product (see NTRUencrypt.encryptBlocks).
+
+Decryption parses every ciphertext on its own, concatenates the blocks of all of them into
+one matrix that is decrypted in a single pass (see NTRUdecrypt.decryptBlocks), and splits
+the result back per ciphertext. A ciphertext that cannot be parsed or decoded only fails
+its own entry.
+"""
+from collections import namedtuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import codec
+import compact
+import metrics
+import sampler
+from ring import circulant_mul
+
+# Upper bound on the number of int64 values gathered at once (i.e. 8 * MAX_GATHER bytes)
+MAX_GATHER = 1 << 22
+
+# Maximum number of blocks decrypted in one pass
+MAX_BLOCKS = 1 << 14
+
+# Outcome of decrypting one ciphertext: the plaintext (str for text ciphertexts, bytes for
+# packed ones) and None, or None and the exception that made it fail
+DecryptResult = namedtuple("DecryptResult", ["plaintext", "error"])
+
+
+def params_key(encryptor):
+    """
+    Return the parameters that decide whether two public keys can share a batch.
+    """
+    return encryptor.N, encryptor.p, encryptor.q, encryptor.dr
+
+
+@metrics.timed("encrypt.many")
+def encrypt_blocks_many(encryptors, B, rng=None):
+    """
+    Encrypt the message blocks B for every public key in encryptors, each block under every
+    key with its own random blinding polynomial.
+
+    INPUTS:
+    =======
+    encryptors : List of NTRUencrypt objects with the public key read, all with the same
+                 parameters (see params_key).
+    B          : Integer array of shape (blocks, N), the message blocks.
+    rng        : Random source for the blinding polynomials (see sampler.py).
+
+    RETURNS:
+    ========
+    An array of shape (len(encryptors), blocks, N), the encrypted blocks per key (int16 for
+    the usual q, see compact.centered).
+    """
+    if not encryptors:
+        raise ValueError("No public keys to encrypt for")
+    first = encryptors[0]
+    N, p, q, dr = params_key(first)
+    if any(params_key(E) != (N, p, q, dr) for E in encryptors):
+        raise ValueError("All public keys of a batch must have the same parameters")
+    if not all(E.readKey for E in encryptors):
+        raise ValueError("Public key not read before encryption")
+    B = np.asarray(B, dtype=np.int64)
+    if B.ndim != 2 or B.shape[1] != N:
+        raise ValueError("Message blocks must be given as a (blocks, N) array")
+    if np.any(np.abs(B) > p / 2):
+        raise ValueError("Elements of message must be in [-p/2,p/2]")
+
+    k, blocks = len(encryptors), B.shape[0]
+    metrics.inc("encrypt.block_count", k * blocks)
+
+    if blocks * 2 * dr > N:
+        # Enough blocks per key for the circulant matrix product to be cheaper
+        R = sampler.ternary(k * blocks, N, dr, dr, rng).reshape(k, blocks, N)
+        out = np.stack([circulant_mul(R[i], E.table("h")) for i, E in enumerate(encryptors)])
+        out += B[None]
+        return compact.centered(out, q)
+
+    # Row N-1-i of the window view over h twice is h rotated by x^(N-1-i), for every key
+    H = np.stack([np.asarray(E.h, dtype=np.int64) for E in encryptors])
+    rotations = sliding_window_view(np.concatenate((H, H), axis=1), N, axis=1)
+
+    # One blinding polynomial per (key, block) pair, pair j belongs to key j // blocks
+    plus, minus = sampler.ternary(k * blocks, N, dr, dr, rng, sparse=True)
+    owner = np.repeat(np.arange(k), blocks)[:, None]
+
+    out = np.empty((k * blocks, N), dtype=np.int64)
+    step = max(1, MAX_GATHER // (2 * dr * N))
+    for s in range(0, k * blocks, step):
+        rows = owner[s:s + step]
+        out[s:s + step] = (rotations[rows, N - 1 - plus[s:s + step]].sum(axis=1)
+                           - rotations[rows, N - 1 - minus[s:s + step]].sum(axis=1))
+
+    out = out.reshape(k, blocks, N)
+    out += B[None]
+    return compact.centered(out, q)
+
+
+def _parse(decryptor, cipher):
+    """
+    Parse one ciphertext for decrypt_many.
+
+    RETURNS:
+    ========
+    A tuple (blocks, finish) where blocks is the (blocks, N) array to decrypt, or None for
+    a hybrid ciphertext, and finish turns the decrypted blocks into the plaintext.
+    """
+    if isinstance(cipher, str):
+        if cipher.startswith(codec.HYBRID_TEXT_PREFIX):
+            import hybrid
+            container = hybrid.from_text(cipher)
+            return None, lambda _: hybrid.decrypt(decryptor, container).decode("utf-8", errors="ignore")
+        E = np.fromstring(cipher, dtype=np.int64, sep=" ")
+        # Any whitespace separates the integers, as in NTRUdecrypt.decryptString
+        if len(E) != len(cipher.split()):
+            raise ValueError("Input decrypt string is not a list of integers")
+        if len(E) % decryptor.N != 0:
+            raise ValueError("Input decrypt string is not integer multiple of N")
+        return E.reshape(-1, decryptor.N), lambda M: codec.decode_message(M).decode("utf-8", errors="ignore")
+
+    if codec.is_hybrid(cipher):
+        import hybrid
+        return None, lambda _: hybrid.decrypt(decryptor, cipher)
+    header, E = codec.unpack_ciphertext(cipher)
+    if (header["N"], header["q"]) != (decryptor.N, decryptor.q):
+        raise ValueError("Ciphertext parameters N={}, q={} do not match the key".format(header["N"], header["q"]))
+    return E, lambda M: codec.blocks_to_bytes(M, header["length"], header["encoding"])
+
+
+@metrics.timed("decrypt.many")
+def decrypt_many(decryptor, ciphertexts):
+    """
+    Decrypt many independent ciphertexts under the private key of decryptor.
+
+    INPUTS:
+    =======
+    decryptor   : NTRUdecrypt object with the private key read.
+    ciphertexts : Iterable of ciphertexts, each either a text ciphertext (str, as returned
+                  by ntru.encrypt) or a packed ciphertext or hybrid container (bytes, as
+                  returned by ntru.encrypt_bytes).
+
+    RETURNS:
+    ========
+    A list with one DecryptResult per ciphertext, in order.
+    """
+    results = []
+    parsed = []
+    for cipher in ciphertexts:
+        try:
+            parsed.append(_parse(decryptor, cipher))
+        except (ValueError, TypeError) as err:
+            parsed.append(err)
+
+    # Decrypt the blocks of all parsed ciphertexts together
+    batches = [p[0] for p in parsed if isinstance(p, tuple) and p[0] is not None]
+    if batches:
+        E = np.concatenate(batches)
+        M = np.concatenate([decryptor.decryptBlocks(E[s:s + MAX_BLOCKS]) for s in range(0, len(E), MAX_BLOCKS)])
+    offset = 0
+
+    for p in parsed:
+        if not isinstance(p, tuple):
+            results.append(DecryptResult(None, p))
+            continue
+        blocks, finish = p
+        if blocks is None:
+            part = None
+        else:
+            part = M[offset:offset + len(blocks)]
+            offset += len(blocks)
+        try:
+            results.append(DecryptResult(finish(part), None))
+        except ValueError as err:
+            results.append(DecryptResult(None, err))
+    return results
@@ -0,0 +1,325 @@
+"""
+Benchmark suite for the NTRU implementation.
+
+Measures key generation, the key security checks, single and multi block encryption and
+decryption, the dense ring product with every multiplication backend, key file writing and
+loading and the message/ciphertext codecs, for every
+parameter set in ntru.PARAM_SETS and a range of message sizes. Every benchmark reports the
+median, 95th percentile and minimum time, the throughput (for benchmarks with a payload)
+and the peak memory allocated by one run (measured separately with tracemalloc, so that
+tracing does not slow down the timed runs).
+
+The cold start (importing ntru, then encrypting with a key) is measured in fresh
+interpreters, which also checks that sympy is never imported: if it is, the exit status
+is 1.
+
+Usage:
+    python -m benchmark --output results.json
+    python -m benchmark --modes moderate highest --sizes 16 4096 --repeat 10
+    python -m benchmark --output new.json --compare baseline.json --threshold 0.25
+    python -m benchmark --load new.json --compare baseline.json
+
+In compare mode every benchmark whose median time grew by more than the threshold (a
+fraction, 0.2 = 20%) against the baseline is reported as a regression and the exit status
+is 1.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+import codec
+import hybrid
+import ntru
+from logger import logger
+from NTRUdecrypt import NTRUdecrypt
+from NTRUencrypt import NTRUencrypt
+from ring import center_lift, cyclic_mul
+
+SIZES = (16, 1024, 64 * 1024)
+REPEAT = 5
+THRESHOLD = 0.2
+
+# Run in a fresh interpreter: prints the time to import ntru, the time to then encrypt twice
+# with the key named by the first argument (if any), and whether sympy got imported
+STARTUP_PROBE = """
+import sys, time
+start = time.perf_counter()
+import ntru
+imported = time.perf_counter()
+if len(sys.argv) > 1:
+    ntru.logger.setLevel(30)
+    ntru.encrypt(sys.argv[1], "probe")
+    ntru.encrypt(sys.argv[1], "probe")
+done = time.perf_counter()
+print(imported - start, done - imported, int("sympy" in sys.modules))
+"""
+
+
+def measure(func, repeat=REPEAT, nbytes=None, warmup=1):
+    """
+    Time func() repeat times (after warmup untimed calls) and measure its peak memory.
+
+    INPUTS:
+    =======
+    func    : Callable without arguments, the operation to benchmark.
+    repeat  : Integer, the number of timed runs.
+    nbytes  : Integer, the payload size handled by one run, to report the throughput.
+    warmup  : Integer, the number of untimed runs first (to fill caches and tables).
+
+    RETURNS:
+    ========
+    A dictionary with the runs, median_s, p95_s, min_s and peak_bytes entries, and
+    throughput_Bps if nbytes is given.
+    """
+    for _ in range(warmup):
+        func()
+
+    times = np.empty((repeat,))
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times[i] = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return _stats(times, nbytes, peak)
+
+
+def _stats(times, nbytes=None, peak=None):
+    times = np.asarray(times, dtype=float)
+    stats = {
+        "runs": len(times),
+        "median_s": float(np.median(times)),
+        "p95_s": float(np.percentile(times, 95)),
+        "min_s": float(times.min()),
+        "peak_bytes": None if peak is None else int(peak),
+    }
+    if nbytes is not None:
+        stats["throughput_Bps"] = nbytes / stats["median_s"] if stats["median_s"] > 0 else float("inf")
+    return stats
+
+
+def measure_startup(repeat=REPEAT, key=None):
+    """
+    Measure the cold start in repeat fresh interpreters: importing ntru and, if key (the name
+    of a key pair) is given, encrypting twice with it afterwards.
+
+    RETURNS:
+    ========
+    A tuple of two statistics dictionaries (see measure, without peak memory), for the
+    import and for the encryptions, each with a sympy_imported entry.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    imports, encrypts, sympy = [], [], False
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", STARTUP_PROBE] + ([key] if key else []), cwd=here,
+                             capture_output=True, text=True, check=True).stdout.split()
+        imports.append(float(out[0]))
+        encrypts.append(float(out[1]))
+        sympy = sympy or out[2] == "1"
+    import_stats, encrypt_stats = _stats(imports), _stats(encrypts)
+    import_stats["sympy_imported"] = encrypt_stats["sympy_imported"] = sympy
+    return import_stats, encrypt_stats
+
+
+def _keygen(params):
+    N1 = NTRUdecrypt(logger, debug=False, check_time=False)
+    N1.setNpq(**params)
+    N1.genfg()
+    N1.genh()
+    return N1
+
+
+def bench_mode(mode, sizes=SIZES, repeat=REPEAT, directory=None):
+    """
+    Run every benchmark for the parameter set mode.
+
+    RETURNS:
+    ========
+    A dictionary benchmark name -> statistics (see measure). Names are "<mode>/<operation>"
+    or "<mode>/<operation>/<size>" for benchmarks over a message of size bytes.
+    """
+    params = ntru.PARAM_SETS[mode]
+    results = {}
+
+    def run(name, func, nbytes=None):
+        results["{}/{}".format(mode, name)] = measure(func, repeat, nbytes)
+
+    run("keygen", lambda: _keygen(params))
+    D = _keygen(params)
+    run("security_check", lambda: ntru.security_check(D))
+    run("attack_simulation", lambda: ntru.attack_simulation(D))
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for fmt, binary in (("text", False), ("binary", True)):
+            stem = os.path.join(tmp, "key_" + fmt)
+            run("key_write_" + fmt, lambda: (D.writePub(stem, binary), D.writePriv(stem, binary)))
+
+            def load():
+                E = NTRUencrypt()
+                E.readPub(stem + ".pub")
+                D1 = NTRUdecrypt(logger, debug=False, check_time=False)
+                D1.readPriv(stem + ".priv")
+                D1.precompute()
+                return E
+
+            run("key_load_" + fmt, load)
+        E = load()
+        results["{}/startup_encrypt".format(mode)] = measure_startup(repeat, stem)[1]
+    D.precompute()
+
+    m = np.random.randint(0, 2, size=(1, D.N))
+    e = E.encryptBlocks(m)
+    run("encrypt_block", lambda: E.encryptBlocks(m))
+    run("decrypt_block", lambda: D.decryptBlocks(e))
+
+    # The dense product of decryption (fp times a centered ternary polynomial) per backend
+    b = center_lift(e[0], D.p)
+    for backend in ("convolve", "karatsuba", "fft"):
+        run("ring_mul_" + backend, lambda backend=backend: cyclic_mul(D.fp, b, D.N, backend))
+
+    for size in sizes:
+        data = os.urandom(size)
+        blocks = codec.encode_message(data, D.N)
+        E.encryptString(data)
+        cipher = E.Me
+        packed = codec.pack_ciphertext(E.encryptBlocks(blocks), D.q, size)
+        _, unpacked = codec.unpack_ciphertext(packed)
+        container = hybrid.encrypt(E, data)
+
+        run("encode/{}".format(size), lambda: codec.encode_message(data, D.N), size)
+        run("decode/{}".format(size), lambda: codec.decode_message(blocks), size)
+        run("pack/{}".format(size), lambda: codec.pack_ciphertext(unpacked, D.q, size), size)
+        run("unpack/{}".format(size), lambda: codec.unpack_ciphertext(packed), size)
+        run("encrypt/{}".format(size), lambda: E.encryptString(data), size)
+        run("decrypt/{}".format(size), lambda: D.decryptString(cipher), size)
+        run("hybrid_encrypt/{}".format(size), lambda: hybrid.encrypt(E, data), size)
+        run("hybrid_decrypt/{}".format(size), lambda: hybrid.decrypt(D, container), size)
+
+    return results
+
+
+def run_benchmarks(modes=None, sizes=SIZES, repeat=REPEAT):
+    """
+    Run the benchmarks for the parameter sets modes (all of ntru.PARAM_SETS by default).
+
+    RETURNS:
+    ========
+    A dictionary with the environment ("meta") and the statistics of every benchmark
+    ("results"), ready to be written as JSON.
+    """
+    modes = list(modes or ntru.PARAM_SETS)
+    level = logger.level
+    # The library logs every call at INFO level, which would end up in the timings
+    logger.setLevel(logging.WARNING)
+    try:
+        results = {"startup/import": measure_startup(repeat)[0]}
+        for mode in modes:
+            results.update(bench_mode(mode, sizes, repeat))
+    finally:
+        logger.setLevel(level)
+
+    meta = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "modes": modes,
+        "sizes": list(sizes),
+        "repeat": repeat,
+    }
+    return {"meta": meta, "results": results}
+
+
+def compare(current, baseline, threshold=THRESHOLD, metric="median_s"):
+    """
+    Compare two benchmark reports (as returned by run_benchmarks).
+
+    RETURNS:
+    ========
+    A list of (name, baseline value, current value, ratio) tuples for every benchmark
+    present in both reports whose metric grew by more than threshold, slowest first.
+    """
+    regressions = []
+    for name, stats in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None or base.get(metric, 0) <= 0:
+            continue
+        ratio = stats[metric] / base[metric]
+        if ratio > 1 + threshold:
+            regressions.append((name, base[metric], stats[metric], ratio))
+    return sorted(regressions, key=lambda r: r[3], reverse=True)
+
+
+def format_report(report):
+    """
+    Format the statistics of a benchmark report as a text table.
+    """
+    lines = ["{:<34} {:>11} {:>11} {:>13} {:>11}".format("benchmark", "median ms", "p95 ms", "MB/s", "peak KB")]
+    for name, stats in report["results"].items():
+        throughput = stats.get("throughput_Bps")
+        lines.append("{:<34} {:>11.3f} {:>11.3f} {:>13} {:>11.1f}".format(
+            name, 1e3 * stats["median_s"], 1e3 * stats["p95_s"],
+            "-" if throughput is None else "{:.2f}".format(throughput / 1e6),
+            float("nan") if stats["peak_bytes"] is None else stats["peak_bytes"] / 1024))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Benchmark the NTRU implementation.")
+    parser.add_argument("--modes", nargs="+", choices=list(ntru.PARAM_SETS), help="parameter sets (default: all)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(SIZES), help="message sizes in bytes")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="timed runs per benchmark")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--load", help="read the results from this JSON file instead of running the benchmarks")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="relative slowdown of the median reported as a regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    if args.load:
+        with open(args.load) as f:
+            report = json.load(f)
+    else:
+        report = run_benchmarks(args.modes, args.sizes, args.repeat)
+    print(format_report(report))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    status = 0
+    if any(stats.get("sympy_imported") for stats in report["results"].values()):
+        print("ERROR: importing ntru and encrypting imported sympy")
+        status = 1
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        for name, old, new, ratio in regressions:
+            print("REGRESSION {}: {:.3f} ms -> {:.3f} ms ({:+.0%})".format(name, 1e3 * old, 1e3 * new, ratio - 1))
+        if regressions:
+            return 1
+        print("No regressions above {:.0%}".format(args.threshold))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
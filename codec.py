@@ -0,0 +1,318 @@
+"""
+Message and ciphertext codecs.
+
+Messages (encode_message/decode_message) are framed before encryption: a 9 byte header
+    encoding u8 | length u64 (big-endian)
+is placed in front of the message bytes, so that the decrypted blocks can be cut back to
+the exact message, whatever bytes it contains.
+
+A packed binary ciphertext starts with a fixed 24 byte little-endian header
+    magic "NTRC" | version u8 | encoding u8 | N u16 | q u16 | reserved u16 | blocks u32 | length u64
+where length is the number of plaintext bytes, followed by the blocks x N ciphertext
+coefficients reduced into [0, q) and stored at ceil(log2 q) bits each (big-endian bit order).
+"""
+import struct
+
+import numpy as np
+
+import metrics
+
+MAGIC = b"NTRC"
+VERSION = 1
+
+# Markers of hybrid containers and their text form (see hybrid.py), defined here so that
+# recognising them does not need the hashing modules hybrid.py imports
+HYBRID_MAGIC = b"NTRH"
+HYBRID_TEXT_PREFIX = "NTRH:"
+
+# Message encodings, i.e. how plaintext bytes are mapped onto message coefficients: one bit
+# per coefficient, or balanced ternary digits (about log2(3) bits per coefficient, needs p >= 3)
+ENCODING_BITS = 0
+ENCODING_TERNARY = 1
+ENCODINGS = {"bits": ENCODING_BITS, "ternary": ENCODING_TERNARY}
+
+TRITS_PER_WORD = 41
+
+# Framing header in front of every encoded message
+FRAME = struct.Struct(">BQ")
+
+HEADER = np.dtype([("magic", "S4"), ("version", "<u1"), ("encoding", "<u1"), ("N", "<u2"), ("q", "<u2"),
+                   ("reserved", "<u2"), ("blocks", "<u4"), ("length", "<u8")])
+
+
+# Number of coefficients (un)packed at a time, a multiple of 8 so that every chunk starts on a
+# byte boundary. The bit level scratch arrays take at most 16 (32 for q > 65536) bytes per
+# coefficient of a chunk, whatever the size of the ciphertext.
+PACK_CHUNK = 1 << 16
+
+
+def coeff_bits(q):
+    """
+    Return the number of bits needed to store a coefficient mod q, i.e. ceil(log2 q).
+    """
+    return (q - 1).bit_length()
+
+
+def _word(nbits):
+    """ The big-endian word type the coefficients of nbits bits are unpacked from """
+    return np.dtype(">u2") if nbits <= 16 else np.dtype(">u4")
+
+
+def pack_coeffs(E, q):
+    """
+    Reduce the coefficients in E into [0, q) and pack them into bytes, ceil(log2 q) bits
+    per coefficient.
+    """
+    nbits = coeff_bits(q)
+    word = _word(nbits)
+    width = 8 * word.itemsize
+    E = np.asarray(E).ravel()
+    out = np.empty((-(-len(E) * nbits // 8),), dtype=np.uint8)
+    for start in range(0, len(E), PACK_CHUNK):
+        v = np.mod(E[start:start + PACK_CHUNK].astype(np.int64), q).astype(word)
+        # Unpack the big-endian words and keep their low nbits bits
+        bits = np.unpackbits(v.view(np.uint8)).reshape(-1, width)[:, width - nbits:]
+        packed = np.packbits(bits)
+        offset = start * nbits // 8
+        out[offset:offset + len(packed)] = packed
+    return out.tobytes()
+
+
+def unpack_coeffs(buf, count, q):
+    """
+    Unpack count coefficients mod q from the bytes buf written by pack_coeffs.
+
+    RETURNS:
+    ========
+    An int64 array of count coefficients in [0, q).
+    """
+    nbits = coeff_bits(q)
+    if len(buf) * 8 < count * nbits:
+        raise ValueError("Packed ciphertext is truncated")
+    word = _word(nbits)
+    width = 8 * word.itemsize
+    data = np.frombuffer(buf, dtype=np.uint8)
+    E = np.empty((count,), dtype=np.int64)
+    for start in range(0, count, PACK_CHUNK):
+        k = min(PACK_CHUNK, count - start)
+        chunk = data[start * nbits // 8:-(-(start + k) * nbits // 8)]
+        bits = np.zeros((k, width), dtype=np.uint8)
+        bits[:, width - nbits:] = np.unpackbits(chunk, count=k * nbits).reshape(k, nbits)
+        E[start:start + k] = np.packbits(bits).view(word)
+    return E
+
+
+def bytes_to_trits(data):
+    """
+    Convert bytes into balanced ternary digits in {-1, 0, 1}: every 8 bytes (zero padded at
+    the end) are read as a big-endian 64 bit word w and w - 2^63 is written as 41 digits,
+    least significant digit first (|w - 2^63| <= 2^63 < (3^41 - 1) / 2).
+    """
+    data = bytes(data)
+    words = np.frombuffer(data + bytes(-len(data) % 8), dtype=">u8").astype(np.uint64)
+    # Flipping the top bit and reading the word as signed gives w - 2^63
+    s = (words ^ np.uint64(1 << 63)).view(np.int64)
+    trits = np.empty((len(words), TRITS_PER_WORD), dtype=np.int64)
+    for i in range(TRITS_PER_WORD):
+        s, d = np.divmod(s, 3)
+        # A digit 2 is written as -1 with a carry into the next digit
+        s += d == 2
+        trits[:, i] = d
+    trits[trits == 2] = -1
+    return trits.ravel()
+
+
+def trits_to_bytes(trits, length):
+    """
+    Convert balanced ternary digits written by bytes_to_trits back into length bytes.
+    """
+    words = -(-length // 8)
+    trits = np.asarray(trits).ravel()[:words * TRITS_PER_WORD]
+    if len(trits) < words * TRITS_PER_WORD:
+        raise ValueError("Decrypted message is shorter than the recorded length")
+    trits = trits.reshape(words, TRITS_PER_WORD).astype(np.int64)
+    s = np.zeros((words,), dtype=np.int64)
+    for i in range(TRITS_PER_WORD - 1, -1, -1):
+        s = s * 3 + trits[:, i]
+    return (s.view(np.uint64) ^ np.uint64(1 << 63)).astype(">u8").tobytes()[:length]
+
+
+def to_coeffs(data, encoding=ENCODING_BITS):
+    """
+    Convert the bytes data into message coefficients with the given encoding.
+    """
+    if encoding == ENCODING_BITS:
+        return np.unpackbits(np.frombuffer(bytes(data), dtype=np.uint8)).astype(np.int64)
+    if encoding == ENCODING_TERNARY:
+        return bytes_to_trits(data)
+    raise ValueError("Unknown message encoding {}".format(encoding))
+
+
+def from_coeffs(coeffs, length, encoding=ENCODING_BITS):
+    """
+    Convert message coefficients (as produced by to_coeffs) back into the first length bytes
+    they carry.
+    """
+    if encoding == ENCODING_BITS:
+        bits = np.asarray(coeffs).ravel()[:8 * length]
+        if len(bits) < 8 * length:
+            raise ValueError("Decrypted message is shorter than the recorded length")
+        return np.packbits(bits.astype(np.uint8)).tobytes()
+    if encoding == ENCODING_TERNARY:
+        return trits_to_bytes(coeffs, length)
+    raise ValueError("Unknown message encoding {}".format(encoding))
+
+
+def to_blocks(coeffs, N):
+    """
+    Pad the message coefficients with trailing zeros into a (blocks, N) array (at least one
+    block is always returned).
+    """
+    blocks = max(1, -(-len(coeffs) // N))
+    B = np.zeros((blocks * N,), dtype=np.int64)
+    B[:len(coeffs)] = coeffs
+    return B.reshape(blocks, N)
+
+
+def bytes_to_blocks(data, N, encoding=ENCODING_BITS):
+    """
+    Convert the bytes data into a (blocks, N) array of message coefficients with the given
+    encoding, padded with trailing zeros.
+    """
+    return to_blocks(to_coeffs(data, encoding), N)
+
+
+def blocks_to_bytes(M, length, encoding=ENCODING_BITS):
+    """
+    Convert decrypted message blocks (as produced by bytes_to_blocks) back into the
+    first length bytes they carry.
+    """
+    return from_coeffs(np.asarray(M).ravel(), length, encoding)
+
+
+@metrics.timed("codec.encode")
+def encode_message(data, N, encoding=ENCODING_BITS):
+    """
+    Frame the message data and convert it into a (blocks, N) array of message coefficients.
+    The frame header is always written as bits, the message itself with the given encoding.
+
+    INPUTS:
+    =======
+    data     : Bytes or string (encoded as UTF-8), the message.
+    N        : Integer, the number of coefficients per block.
+    encoding : Integer, the message encoding to use.
+
+    RETURNS:
+    ========
+    An int64 array of shape (blocks, N).
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    metrics.inc("codec.bytes_encoded", len(data))
+    header = to_coeffs(FRAME.pack(encoding, len(data)))
+    return to_blocks(np.concatenate((header, to_coeffs(data, encoding))), N)
+
+
+@metrics.timed("codec.decode")
+def decode_message(M):
+    """
+    Recover the message bytes from decrypted blocks built by encode_message.
+    """
+    coeffs = np.asarray(M).ravel()
+    if len(coeffs) < 8 * FRAME.size:
+        raise ValueError("Decrypted message is too short to hold a message header")
+    encoding, length = FRAME.unpack(from_coeffs(coeffs[:8 * FRAME.size], FRAME.size))
+    metrics.inc("codec.bytes_decoded", length)
+    return from_coeffs(coeffs[8 * FRAME.size:], length, encoding)
+
+
+def is_hybrid(buf):
+    """
+    Return True if the bytes buf start like a hybrid container (see hybrid.py).
+    """
+    return bytes(buf[:len(HYBRID_MAGIC)]) == HYBRID_MAGIC
+
+
+@metrics.timed("codec.pack")
+def pack_ciphertext(E, q, length, encoding=ENCODING_BITS):
+    """
+    Build a packed ciphertext from the encrypted blocks E (shape (blocks, N)).
+
+    INPUTS:
+    =======
+    E        : Integer array of shape (blocks, N), the encrypted blocks.
+    q        : Integer, the modulus q of the key used.
+    length   : Integer, the number of plaintext bytes.
+    encoding : Integer, the message encoding used to build the blocks.
+
+    RETURNS:
+    ========
+    The packed ciphertext as bytes.
+    """
+    E = np.asarray(E)
+    return pack_header(E.shape[1], q, E.shape[0], length, encoding) + pack_coeffs(E, q)
+
+
+def pack_header(N, q, blocks, length, encoding=ENCODING_BITS):
+    """
+    Return the header of a packed ciphertext of blocks encrypted blocks (see pack_ciphertext),
+    to be followed by their coefficients as written by pack_coeffs.
+    """
+    header = np.zeros((), dtype=HEADER)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["encoding"] = encoding
+    header["N"] = N
+    header["q"] = q
+    header["blocks"] = blocks
+    header["length"] = length
+    return header.tobytes()
+
+
+def read_header(buf):
+    """
+    Parse and check the header of a packed ciphertext.
+
+    RETURNS:
+    ========
+    A dictionary with the header fields.
+    """
+    if len(buf) < HEADER.itemsize or bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Input is not a packed NTRU ciphertext")
+    header = np.frombuffer(buf, dtype=HEADER, count=1)[0]
+    if header["version"] != VERSION:
+        raise ValueError("Unsupported ciphertext version {}".format(header["version"]))
+    return {name: int(header[name]) for name in ("encoding", "N", "q", "blocks", "length")}
+
+
+def packed_size(header):
+    """
+    Return the total size in bytes of the packed ciphertext described by header.
+    """
+    return HEADER.itemsize + -(-header["blocks"] * header["N"] * coeff_bits(header["q"]) // 8)
+
+
+def split_ciphertext(buf):
+    """
+    Split a packed ciphertext into its header (a dictionary, see read_header) and a
+    memoryview of the packed coefficients.
+    """
+    header = read_header(buf)
+    return header, memoryview(buf)[HEADER.itemsize:packed_size(header)]
+
+
+@metrics.timed("codec.unpack")
+def unpack_ciphertext(buf):
+    """
+    Split a packed ciphertext into its header and encrypted blocks.
+
+    RETURNS:
+    ========
+    A tuple (header, E) where header is a dictionary with the header fields and E an int64
+    array of shape (blocks, N) with the coefficients center-lifted mod q.
+    """
+    header, payload = split_ciphertext(buf)
+    N, q = header["N"], header["q"]
+    E = unpack_coeffs(payload, header["blocks"] * N, q)
+    E[E > q // 2] -= q
+    return header, E.reshape(header["blocks"], N)
@@ -0,0 +1,154 @@
+"""
+Compact storage of polynomial coefficients.
+
+All arithmetic (see ring.py) is done on int64, but the polynomials kept around (keys in the
+key cache, blinding polynomials, block matrices) are stored with the smallest integer type
+their values fit:
+    ternary polynomials (f, g, r) and data mod p (fp, decrypted blocks) : int8
+    residues mod q in [0, q) (fq)                                       : uint16
+    centered values mod q (h, encrypted blocks)                         : int16
+for q = 2048..8192 (smaller moduli fit int8, larger ones get wider types). That is 4 to 8
+times less memory than int64, and ternary polynomials can be packed further to 2 bits per
+coefficient (PackedTernary), a form that ring.cyclic_mul multiplies directly. Residues
+mod a power of two are reduced by masking (see ring.reduce_mod).
+
+Every function of ring.py converts its operands to int64 first, so compact arrays can be
+passed anywhere a polynomial is expected. Arithmetic on compact arrays outside of ring.py
+must do the same to avoid overflowing the narrow types.
+"""
+import numpy as np
+
+from ring import center_lift, reduce_mod
+
+# Candidate storage types, smallest first
+DTYPES = tuple(np.dtype(t) for t in (np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32, np.int64))
+
+# Coefficient -> 2 bit code (the low two bits of the two's complement), and back
+_CODE_VALUES = np.array([0, 1, 0, -1], dtype=np.int8)
+_SHIFTS = np.array([0, 2, 4, 6], dtype=np.uint8)
+
+
+def int_dtype(low, high):
+    """
+    Return the smallest integer dtype holding every value in [low, high].
+    """
+    for dtype in DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    raise ValueError("No integer type holds [{}, {}]".format(low, high))
+
+
+def residue_dtype(m):
+    """ Storage type of residues mod m in [0, m) """
+    return int_dtype(0, m - 1)
+
+
+def centered_dtype(m):
+    """ Storage type of values mod m in the centered range of ring.center_lift """
+    return int_dtype(m // 2 - m + 1, m // 2)
+
+
+def narrow(a):
+    """
+    Return the integer array a in the smallest dtype holding its values.
+    """
+    a = np.asarray(a)
+    if a.size == 0:
+        return a.astype(np.int8)
+    return a.astype(int_dtype(int(a.min()), int(a.max())), copy=False)
+
+
+def ternary(a):
+    """
+    Return the ternary polynomial a (coefficients in {-1, 0, 1}) as an int8 array.
+    """
+    a = np.asarray(a)
+    if a.size and np.abs(a).max() > 1:
+        raise ValueError("Coefficients of a ternary polynomial must be in {-1, 0, 1}")
+    return a.astype(np.int8, copy=False)
+
+
+def residues(a, m):
+    """
+    Reduce all coefficients of a into [0, m) (by masking for m a power of two) and return them
+    in the storage type for residues mod m, e.g. uint16 for q <= 65536.
+    """
+    return reduce_mod(a, m).astype(residue_dtype(m), copy=False)
+
+
+def centered(a, m):
+    """
+    Reduce all coefficients of a into the centered range mod m (see ring.center_lift) and
+    return them in the storage type for that range, e.g. int8 for p = 3, int16 for q = 4096.
+    """
+    return center_lift(a, m).astype(centered_dtype(m), copy=False)
+
+
+class PackedTernary:
+    """
+    Ternary polynomial, or matrix of ternary polynomials (one per row), packed to 2 bits
+    per coefficient: four coefficients per byte, the first one in the lowest bits, each coded
+    as the low two bits of its two's complement (0 -> 00, 1 -> 01, -1 -> 11).
+
+    np.asarray(packed) unpacks the coefficients as int8, and ring.cyclic_mul takes packed
+    polynomials directly (through indices, for its sparse kernel).
+    """
+
+    __slots__ = ("data", "shape")
+
+    def __init__(self, data, shape):
+        self.data = data
+        self.shape = tuple(shape)
+
+    @classmethod
+    def pack(cls, a):
+        """
+        Pack the ternary polynomial (or matrix of polynomials, packed row by row) a.
+        """
+        a = ternary(a)
+        N = a.shape[-1]
+        codes = np.bitwise_and(a.view(np.uint8), 3)
+        codes = np.pad(codes, [(0, 0)] * (a.ndim - 1) + [(0, -N % 4)])
+        codes = codes.reshape(a.shape[:-1] + (-1, 4)) << _SHIFTS
+        return cls(np.bitwise_or.reduce(codes, axis=-1), a.shape)
+
+    def codes(self):
+        """ The 2 bit code of every coefficient, as a uint8 array of the unpacked shape """
+        codes = (self.data[..., None] >> _SHIFTS) & 3
+        return codes.reshape(self.data.shape[:-1] + (-1,))[..., :self.shape[-1]]
+
+    def unpack(self):
+        """ The coefficients as an int8 array """
+        return _CODE_VALUES[self.codes()]
+
+    def indices(self):
+        """
+        The sparse form (positions of the +1 and of the -1 coefficients, see
+        ring.ternary_indices) of a single packed polynomial.
+        """
+        if len(self.shape) != 1:
+            raise ValueError("Only a single packed polynomial has a sparse form")
+        codes = self.codes()
+        return np.flatnonzero(codes == 1), np.flatnonzero(codes == 3)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        a = self.unpack()
+        return a if dtype is None else a.astype(dtype, copy=False)
+
+    def __repr__(self):
+        return "PackedTernary(shape={}, nbytes={})".format(self.shape, self.nbytes)
+
+
+def pack_ternary(a):
+    """
+    Return the ternary polynomial (or matrix of polynomials) a in its packed form.
+    """
+    return PackedTernary.pack(a)
@@ -0,0 +1,146 @@
+"""
+Hybrid encryption of large payloads: NTRU carries a random session key, the payload itself
+is encrypted with a symmetric construction built from the standard library only.
+
+A hybrid container is laid out as
+    magic "NTRH" | version u8 | nonce (16 bytes) | length u64 (big-endian)
+    | encapsulated session key (a packed ciphertext, see codec.py)
+    | encrypted payload (length bytes) | tag (32 bytes)
+The session key is encrypted in a single block where N allows (two or three blocks for the
+small parameter sets). From the session key, the nonce and the encapsulated key, SHAKE-256
+derives an encryption key and a MAC key. The payload is XORed with a SHAKE-256 keystream,
+produced in chunks with a block counter. The HMAC-SHA256 tag covers everything before it
+(encrypt-then-MAC).
+
+Encrypting a payload therefore costs one ring multiplication plus hashing throughput,
+whatever its size.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import struct
+
+import numpy as np
+
+import codec
+import metrics
+
+MAGIC = codec.HYBRID_MAGIC
+VERSION = 1
+
+KEY_SIZE = 32
+NONCE_SIZE = 16
+TAG_SIZE = 32
+
+# Number of keystream bytes produced per SHAKE-256 call
+KEYSTREAM_CHUNK = 1 << 20
+
+HEADER = struct.Struct(">4sB{}sQ".format(NONCE_SIZE))
+
+# Prefix of the base64 text form of a container, used by the string API in ntru.py
+TEXT_PREFIX = codec.HYBRID_TEXT_PREFIX
+
+is_hybrid = codec.is_hybrid
+
+
+def to_text(container):
+    """
+    Return the text form of a hybrid container.
+    """
+    return TEXT_PREFIX + base64.b64encode(container).decode("ascii")
+
+
+def from_text(text):
+    """
+    Return the hybrid container held by its text form, or None if text is not one.
+    """
+    if not text.startswith(TEXT_PREFIX):
+        return None
+    return base64.b64decode(text[len(TEXT_PREFIX):], validate=True)
+
+
+def _derive(session, nonce, encapsulated):
+    """
+    Derive the encryption and MAC keys from the session key, bound to the nonce and the
+    encapsulated session key.
+    """
+    okm = hashlib.shake_256(b"NTRU hybrid v1" + session + nonce + encapsulated).digest(2 * KEY_SIZE)
+    return okm[:KEY_SIZE], okm[KEY_SIZE:]
+
+
+def _xor_keystream(key, nonce, data):
+    """
+    XOR data with the SHAKE-256 keystream for key and nonce (the same call encrypts and
+    decrypts).
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    out = np.empty_like(data)
+    for counter, start in enumerate(range(0, len(data), KEYSTREAM_CHUNK)):
+        chunk = data[start:start + KEYSTREAM_CHUNK]
+        stream = hashlib.shake_256(key + nonce + counter.to_bytes(8, "big")).digest(len(chunk))
+        np.bitwise_xor(chunk, np.frombuffer(stream, dtype=np.uint8), out=out[start:start + len(chunk)])
+    return out.tobytes()
+
+
+@metrics.timed("hybrid.encrypt")
+def encrypt(encryptor, data):
+    """
+    Encrypt the bytes data into a hybrid container.
+
+    INPUTS:
+    =======
+    encryptor : NTRUencrypt object with the public key read.
+    data      : Bytes (or string, encoded as UTF-8), the payload.
+
+    RETURNS:
+    ========
+    The hybrid container as bytes.
+    """
+    if not encryptor.readKey:
+        raise ValueError("Public key not read before hybrid encryption")
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    session = os.urandom(KEY_SIZE)
+    nonce = os.urandom(NONCE_SIZE)
+    blocks = encryptor.encryptBlocks(codec.bytes_to_blocks(session, encryptor.N))
+    encapsulated = codec.pack_ciphertext(blocks, encryptor.q, KEY_SIZE)
+
+    enc_key, mac_key = _derive(session, nonce, encapsulated)
+    head = HEADER.pack(MAGIC, VERSION, nonce, len(data)) + encapsulated
+    body = _xor_keystream(enc_key, nonce, data)
+    tag = hmac.new(mac_key, head + body, hashlib.sha256).digest()
+    return head + body + tag
+
+
+@metrics.timed("hybrid.decrypt")
+def decrypt(decryptor, container):
+    """
+    Decrypt a hybrid container (as returned by encrypt) back into the payload bytes.
+    A ValueError is raised if the container is malformed, was made for another key, or has
+    been modified.
+    """
+    container = bytes(container)
+    if len(container) < HEADER.size or not is_hybrid(container):
+        raise ValueError("Input is not a hybrid NTRU container")
+    _, version, nonce, length = HEADER.unpack_from(container)
+    if version != VERSION:
+        raise ValueError("Unsupported hybrid container version {}".format(version))
+
+    header = codec.read_header(container[HEADER.size:])
+    if (header["N"], header["q"]) != (decryptor.N, decryptor.q):
+        raise ValueError("Ciphertext parameters N={}, q={} do not match the key".format(header["N"], header["q"]))
+    body_start = HEADER.size + codec.packed_size(header)
+    if len(container) != body_start + length + TAG_SIZE:
+        raise ValueError("Hybrid container is truncated")
+
+    encapsulated = container[HEADER.size:body_start]
+    _, blocks = codec.unpack_ciphertext(encapsulated)
+    session = codec.blocks_to_bytes(decryptor.decryptBlocks(blocks), KEY_SIZE)
+
+    enc_key, mac_key = _derive(session, nonce, encapsulated)
+    tag = hmac.new(mac_key, container[:body_start + length], hashlib.sha256).digest()
+    if not hmac.compare_digest(tag, container[body_start + length:]):
+        raise ValueError("Hybrid container failed authentication (wrong key or modified data)")
+    return _xor_keystream(enc_key, nonce, container[body_start:body_start + length])
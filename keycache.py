@@ -0,0 +1,157 @@
+"""
+Process-wide cache of parsed NTRU keys.
+
+Keys are cached by file path together with the tables precomputed from them (see
+NTRUencrypt.precompute and NTRUdecrypt.precompute), and invalidated when the modification
+time, size or inode of the key file changes (checked at most every check_interval
+seconds). Key files written by this process (see keyfile.add_write_hook) are invalidated
+right away in every key ring, so only changes made by other processes can go unnoticed for
+up to check_interval.
+"""
+import copy
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import keyfile
+from logger import logger
+from NTRUencrypt import NTRUencrypt
+from NTRUdecrypt import NTRUdecrypt
+
+
+class KeyRing:
+    """
+    A bounded LRU cache of key objects, keyed by key file path.
+
+    Cached objects are never handed out directly: encryptor and decryptor return shallow
+    copies which share the key arrays and precomputed tables with the cached object, but
+    keep the per-call state (message, ciphertext, ...) to themselves.
+    """
+
+    def __init__(self, maxsize=16, check_interval=1.0):
+        """
+        INPUTS:
+        =======
+        maxsize        : Integer, the maximum number of keys kept in the cache.
+        check_interval : Float, the minimum number of seconds between two checks of a key
+                         file for changes (by other processes), 0 checks on every lookup.
+        """
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict()  # (kind, path) -> [key object, file stamp, last check]
+        self._lock = threading.Lock()
+        _keyrings.add(self)
+
+    def encryptor(self, filename, precompute=True):
+        """
+        Return an NTRUencrypt object for the public key file filename.
+        With precompute False a key loaded now gets no tables up front (they are still built,
+        and cached, on first use), which suits keys used once only.
+        """
+        return copy.copy(self._get("pub", filename, precompute))
+
+    def decryptor(self, filename, precompute=True):
+        """
+        Return an NTRUdecrypt object for the private key file filename (see encryptor for
+        precompute).
+        """
+        return copy.copy(self._get("priv", filename, precompute))
+
+    def stats(self):
+        """
+        Return the cache counters as a dictionary.
+        """
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations}
+
+    def invalidate(self, filename):
+        """
+        Drop the cached key loaded from the key file filename, if any.
+        """
+        path = os.path.abspath(filename)
+        with self._lock:
+            for kind in ("pub", "priv"):
+                if self._entries.pop((kind, path), None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        """
+        Drop all cached keys (the counters are kept).
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, kind, filename, precompute=True):
+        path = os.path.abspath(filename)
+        key = (kind, path)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[2] < self.check_interval:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                if _stamp(path) == entry[1]:
+                    entry[2] = now
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+                self.invalidations += 1
+            self.misses += 1
+
+        # Load outside of the lock, so that a slow key file does not block other lookups
+        stamp = _stamp(path)
+        obj = _load(kind, path, precompute)
+
+        with self._lock:
+            self._entries[key] = [obj, stamp, now]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return obj
+
+
+def invalidate(filename):
+    """
+    Drop the cached key loaded from the key file filename from every key ring.
+    """
+    for ring in list(_keyrings):
+        ring.invalidate(filename)
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _load(kind, path, precompute=True):
+    if kind == "pub":
+        obj = NTRUencrypt()
+        obj.readPub(path)
+    else:
+        obj = NTRUdecrypt(logger, debug=False, check_time=False)
+        obj.readPriv(path)
+    if precompute:
+        obj.precompute()
+    return obj
+
+
+# All live key rings, for invalidate
+_keyrings = weakref.WeakSet()
+keyfile.add_write_hook(invalidate)
+
+# The key ring used by ntru.encrypt and ntru.decrypt
+default_keyring = KeyRing()
@@ -0,0 +1,238 @@
+"""
+Versioned binary format for the NTRU public (.pub) and private (.priv) key files.
+
+A binary key file starts with a fixed 32 byte little-endian header
+    magic "NTRU" | version u8 | kind u8 | reserved u16 | N, p, q, df, dg, d as u32
+followed by the coefficient arrays as little-endian int16, N values each:
+    public key  : h
+    private key : f, fp, fq, g
+    key pair    : h, f, fp, fq, g (the records of keystore.py)
+The arrays can be mapped straight from disk with np.memmap (or np.frombuffer), no parsing
+is involved. Public keys store 0 for df and dg, just like the text format omits them.
+
+Key files are replaced atomically (written to a temporary file that is renamed over the
+old one), so keys already mapped from an older version of the file keep their contents.
+Every key file written by this process (binary or text, see NTRUdecrypt.writePub and
+writePriv) is reported to the callbacks registered with add_write_hook, which is how the
+key cache (keycache.py) drops stale keys.
+"""
+import os
+import uuid
+
+import numpy as np
+
+import metrics
+
+MAGIC = b"NTRU"
+VERSION = 1
+
+PUBLIC = 0
+PRIVATE = 1
+PAIR = 2
+
+HEADER = np.dtype([("magic", "S4"), ("version", "<u1"), ("kind", "<u1"), ("reserved", "<u2"),
+                   ("N", "<u4"), ("p", "<u4"), ("q", "<u4"), ("df", "<u4"), ("dg", "<u4"), ("d", "<u4")])
+COEFF = np.dtype("<i2")
+
+# Callbacks called with the name of every key file written, see add_write_hook
+_write_hooks = []
+
+# Number of coefficient arrays stored for each kind of key
+ROWS = {PUBLIC: 1, PRIVATE: 4, PAIR: 5}
+PARAMS = ("N", "p", "q", "df", "dg", "d")
+
+
+def add_write_hook(callback):
+    """
+    Register callback(filename) to be called after a key file has been written.
+    """
+    if callback not in _write_hooks:
+        _write_hooks.append(callback)
+
+
+def written(filename):
+    """
+    Report that the key file filename has been written (to every registered write hook).
+    """
+    for callback in list(_write_hooks):
+        callback(filename)
+
+
+def is_binary(filename):
+    """
+    Return True if filename is a key file in the binary format.
+    """
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+@metrics.timed("key_io.write_key")
+def write_key(filename, kind, params, arrays):
+    """
+    Write a binary key file.
+
+    INPUTS:
+    =======
+    filename : String, the file to write (including the .pub/.priv extension).
+    kind     : PUBLIC, PRIVATE or PAIR.
+    params   : Dictionary with the integer parameters N, p, q, d and, for private keys,
+               df and dg.
+    arrays   : Sequence of coefficient arrays, (h,) for public and (f, fp, fq, g) for
+               private keys, (h, f, fp, fq, g) for key pairs.
+    """
+    # Never write into the existing file: np.memmap views of it (read_key with mmap=True)
+    # would change under the keys holding them, or fault if the file shrinks
+    data = pack_key(kind, params, arrays)
+    tmp = "{}.{}.{}.tmp".format(filename, os.getpid(), uuid.uuid4().hex[:8])
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    written(filename)
+
+
+def pack_key(kind, params, arrays):
+    """
+    Return the binary key (header and coefficient arrays, see write_key) as bytes.
+    """
+    if len(arrays) != ROWS[kind]:
+        raise ValueError("Expected {} coefficient arrays, got {}".format(ROWS[kind], len(arrays)))
+    N = params["N"]
+    if params["q"] > np.iinfo(COEFF).max:
+        raise ValueError("q = {} does not fit the int16 coefficient storage".format(params["q"]))
+
+    header = np.zeros((), dtype=HEADER)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["kind"] = kind
+    for name in PARAMS:
+        header[name] = params.get(name, 0)
+    if kind == PUBLIC:
+        # df and dg are private, see the module docstring
+        header["df"] = header["dg"] = 0
+
+    data = np.zeros((len(arrays), N), dtype=COEFF)
+    for i, a in enumerate(arrays):
+        a = np.asarray(a, dtype=np.int64)
+        # Leading zeros may be missing from keys created by older versions
+        data[i, N - len(a):] = a
+    return header.tobytes() + data.tobytes()
+
+
+def _check_header(header, name):
+    if header["magic"] != MAGIC:
+        raise ValueError("{} is not a binary NTRU key".format(name))
+    if header["version"] != VERSION:
+        raise ValueError("Unsupported key file version {}".format(header["version"]))
+    if header["kind"] not in ROWS:
+        raise ValueError("Unknown key kind {} in {}".format(header["kind"], name))
+
+
+def unpack_key(buf, offset=0):
+    """
+    Read a binary key stored in the buffer buf (e.g. a mmap) at offset, without copying
+    its coefficient arrays.
+
+    RETURNS:
+    ========
+    A tuple (kind, params, arrays, size) as returned by read_key, where arrays is a
+    read-only view into buf and size the number of bytes the key takes.
+    """
+    header = np.frombuffer(buf, dtype=HEADER, count=1, offset=offset)[0]
+    _check_header(header, "buffer at offset {}".format(offset))
+    kind = int(header["kind"])
+    params = {name: int(header[name]) for name in PARAMS}
+    shape = (ROWS[kind], params["N"])
+    arrays = np.frombuffer(buf, dtype=COEFF, count=shape[0] * shape[1],
+                           offset=offset + HEADER.itemsize).reshape(shape)
+    return kind, params, arrays, HEADER.itemsize + arrays.nbytes
+
+
+@metrics.timed("key_io.read_key")
+def read_key(filename, mmap=True):
+    """
+    Read a binary key file.
+
+    INPUTS:
+    =======
+    filename : String, the file to read.
+    mmap     : Boolean, map the coefficient arrays from disk (read-only) instead of
+               reading them into memory.
+
+    RETURNS:
+    ========
+    A tuple (kind, params, arrays), where params is a dictionary of the header parameters
+    and arrays a (rows, N) int16 array with one coefficient array per row.
+    """
+    header = np.fromfile(filename, dtype=HEADER, count=1)
+    if len(header) == 0:
+        raise ValueError("{} is not a binary NTRU key file".format(filename))
+    _check_header(header[0], filename)
+
+    kind = int(header["kind"][0])
+    params = {name: int(header[name][0]) for name in PARAMS}
+    shape = (ROWS[kind], params["N"])
+    if mmap:
+        arrays = np.memmap(filename, dtype=COEFF, mode="r", offset=HEADER.itemsize, shape=shape)
+    else:
+        arrays = np.fromfile(filename, dtype=COEFF, count=shape[0] * shape[1],
+                             offset=HEADER.itemsize).reshape(shape)
+    return kind, params, arrays
+
+
+@metrics.timed("key_io.read_text_key")
+def read_text_key(filename):
+    """
+    Parse a key file in the text format written by NTRUdecrypt.writePub/writePriv.
+
+    RETURNS:
+    ========
+    A tuple (kind, params, arrays) as returned by read_key.
+    """
+    params = {}
+    arrays = []
+    with open(filename, "r") as f:
+        for line in f:
+            if line.startswith("#"):
+                name, _, value = line[1:].partition(":::")
+                name = name.strip()
+                value = value.split()
+                if name == "h":
+                    # The public key coefficients share the line with their label
+                    arrays.append(np.array(value, dtype=np.int64))
+                elif len(value) == 1:
+                    params[name] = int(value[0])
+            elif line.strip():
+                arrays.append(np.array(line.split(), dtype=np.int64))
+
+    kind = PUBLIC if len(arrays) == ROWS[PUBLIC] else PRIVATE
+    if len(arrays) != ROWS[kind] or any(name not in params for name in ("N", "p", "q", "d")):
+        raise ValueError("{} is not a valid NTRU key file".format(filename))
+    return kind, params, arrays
+
+
+def convert(src, dst=None):
+    """
+    Convert a text key file into the binary format.
+
+    INPUTS:
+    =======
+    src : String, the text key file to convert.
+    dst : String, the binary key file to write, src is overwritten if None.
+    """
+    kind, params, arrays = read_text_key(src)
+    write_key(src if dst is None else dst, kind, params, arrays)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) not in (2, 3):
+        sys.exit("Usage: python keyfile.py SRC [DST]")
+    convert(*sys.argv[1:])
@@ -0,0 +1,198 @@
+"""
+Pool of pre-generated key pairs, refilled in the background.
+
+Key generation runs in worker processes, so that taking a key pair from the pool (e.g. in
+ntru.generate_keys) costs only the time to write the key files. Optionally the ready key
+pairs are persisted as binary key files (see keyfile.py) in a directory, so that they
+survive restarts. Several processes may share the directory: a persisted pair is claimed
+by renaming its private key file before it is handed out, so every pair is taken once.
+
+Usage:
+    pool = KeyPool({"highest": 4, "dead2": 2}, workers=2, directory="keypool")
+    ntru.generate_keys("tenant", mode="dead2", pool=pool)
+"""
+import os
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from logger import logger
+from NTRUdecrypt import NTRUdecrypt
+
+
+def _init_worker():
+    # Forked workers inherit the random state of the parent, every worker needs its own
+    np.random.seed()
+
+
+def _generate(params):
+    """
+    Generate one key pair for the parameters params (in a worker process).
+    """
+    N1 = NTRUdecrypt(logger, debug=False, check_time=False)
+    N1.setNpq(**params)
+    N1.genfg()
+    N1.genh()
+    return {"f": N1.f, "fp": N1.fp, "fq": N1.fq, "g": N1.g, "h": N1.h}
+
+
+class KeyPool:
+    """
+    Keep a number of ready key pairs per parameter set, generated by worker processes.
+    """
+
+    def __init__(self, sizes, workers=1, directory=None, param_sets=None):
+        """
+        INPUTS:
+        =======
+        sizes      : Dictionary mode -> number of ready key pairs to keep, modes are keys of
+                     ntru.PARAM_SETS (or of param_sets).
+        workers    : Integer, the number of processes generating keys.
+        directory  : String, optional directory the ready key pairs are persisted in.
+        param_sets : Dictionary mode -> parameters, defaults to ntru.PARAM_SETS.
+        """
+        if param_sets is None:
+            from ntru import PARAM_SETS as param_sets
+        for mode in sizes:
+            if mode not in param_sets:
+                raise ValueError("Unknown mode {}".format(mode))
+
+        self.sizes = dict(sizes)
+        self.param_sets = param_sets
+        self.directory = directory
+        self._ready = {mode: deque() for mode in self.sizes}
+        self._pending = {mode: 0 for mode in self.sizes}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._executor = ProcessPoolExecutor(workers, initializer=_init_worker)
+
+        if directory is not None:
+            self._load()
+        self.fill()
+
+    def available(self, mode):
+        """
+        Return the number of ready key pairs for mode.
+        """
+        with self._lock:
+            return len(self._ready.get(mode, ()))
+
+    def take(self, mode):
+        """
+        Take a ready key pair for mode out of the pool and schedule its replacement.
+
+        RETURNS:
+        ========
+        An NTRUdecrypt object holding the key pair (debug and time checks disabled), or None
+        if no key pair for mode is ready.
+        """
+        keys = None
+        while keys is None:
+            with self._lock:
+                ready = self._ready.get(mode)
+                entry = ready.popleft() if ready else None
+            if entry is None:
+                break
+            keys, stem = entry
+            if stem is not None:
+                keys = self._claim(stem, keys)
+        self.fill()
+        return self._keypair(mode, keys) if keys is not None else None
+
+    def fill(self):
+        """
+        Start generating key pairs for every mode below its target size.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            for mode, size in self.sizes.items():
+                while len(self._ready[mode]) + self._pending[mode] < size:
+                    self._pending[mode] += 1
+                    future = self._executor.submit(_generate, self.param_sets[mode])
+                    future.add_done_callback(lambda fut, mode=mode: self._done(mode, fut))
+
+    def close(self, wait=True):
+        """
+        Stop generating key pairs. Persisted key pairs stay on disk for the next start.
+        """
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _done(self, mode, future):
+        with self._lock:
+            self._pending[mode] -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.warning("Key pool generation for %s failed: %s", mode, future.exception())
+            return
+        keys = future.result()
+        stem = self._persist(mode, keys) if self.directory is not None else None
+        with self._lock:
+            self._ready[mode].append((keys, stem))
+
+    def _keypair(self, mode, keys):
+        N1 = NTRUdecrypt(logger, debug=False, check_time=False)
+        N1.setNpq(**self.param_sets[mode])
+        N1.f, N1.fp, N1.fq, N1.g, N1.h = keys["f"], keys["fp"], keys["fq"], keys["g"], keys["h"]
+        return N1
+
+    def _persist(self, mode, keys):
+        N1 = self._keypair(mode, keys)
+        os.makedirs(os.path.join(self.directory, mode), exist_ok=True)
+        stem = os.path.join(self.directory, mode, uuid.uuid4().hex)
+        # The private key is written last, a pair is only loaded again if it is complete
+        N1.writePub(stem, binary=True)
+        N1.writePriv(stem, binary=True)
+        return stem
+
+    def _claim(self, stem, keys):
+        """
+        Claim the persisted key pair stem by renaming its private key file, and remove it.
+        Return the keys (read from the claimed files if keys is None), or None if another
+        process sharing the directory claimed the pair first, or it cannot be read.
+        """
+        claimed = "{}.claimed.{}".format(stem, os.getpid())
+        try:
+            os.rename(stem + ".priv", claimed)
+        except FileNotFoundError:
+            return None
+        try:
+            if keys is None:
+                N1 = NTRUdecrypt(logger, debug=False, check_time=False)
+                try:
+                    N1.readPriv(claimed)
+                    N1.readPub(stem + ".pub")
+                except (ValueError, OSError):
+                    # Left behind half written by an interrupted run
+                    logger.warning("Skipping unreadable pooled key %s", stem)
+                    return None
+                keys = {"f": np.array(N1.f), "fp": np.array(N1.fp), "fq": np.array(N1.fq),
+                        "g": np.array(N1.g), "h": np.array(N1.h)}
+            return keys
+        finally:
+            for filename in (claimed, stem + ".pub"):
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+
+    def _load(self):
+        for mode in self.sizes:
+            path = os.path.join(self.directory, mode)
+            if not os.path.isdir(path):
+                continue
+            for entry in sorted(os.listdir(path)):
+                if not entry.endswith(".priv"):
+                    continue
+                stem = os.path.join(path, entry[:-len(".priv")])
+                if not os.path.exists(stem + ".pub"):
+                    continue
+                # The keys are read when the pair is claimed (see take), other processes
+                # sharing the directory may take it first
+                self._ready[mode].append((None, stem))
@@ -0,0 +1,457 @@
+"""
+Indexed on-disk store for many NTRU keys, looked up by key ID or fingerprint.
+
+A key store is a directory holding two files:
+    keys.dat : the key records, appended one after the other, each a binary key (see
+               keyfile.py) of kind PAIR (h, f, fp, fq, g) or PUBLIC (h)
+    keys.idx : a 32 byte header followed by one fixed size entry per record
+                   key ID u64 | record offset u64 | successor key ID u64 | size u32 | kind u8
+               The first `sorted` entries are sorted by key ID (binary search), entries
+               appended since the last reindex follow unsorted (linear scan).
+Both files are memory mapped, so opening a store costs the same whatever the number of
+keys, and a record is only decoded (as a zero-copy view into the map) when its key is used.
+
+The fingerprint of a key is the SHA-256 of its parameters and public key h (mod q) in hex,
+its key ID the first 16 hex digits of the fingerprint. Keys can be looked up by either.
+
+Records are never changed or removed. Appending writes and syncs the record before its
+index entry, so an interrupted append leaves at most an unreferenced record (and a torn
+index entry, which is ignored). Rotating a key appends the new key and then sets the
+successor of the old entry in place (a single aligned 8 byte write): the old key can
+still decrypt, but no longer encrypt. Writers are serialised with a lock file (on
+platforms with fcntl), and reindex replaces the index atomically.
+
+Usage:
+    store = keystore.KeyStore("keys")
+    key_id = store.add(decryptor)       # NTRUdecrypt with a key pair, or NTRUencrypt
+    E = store.encryptor(key_id)
+    new_id = store.rotate(key_id, new_decryptor)
+"""
+import bisect
+import copy
+import functools
+import hashlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from string import hexdigits
+
+import numpy as np
+
+import compact
+import keyfile
+from logger import logger
+from NTRUdecrypt import NTRUdecrypt
+from NTRUencrypt import NTRUencrypt
+
+DATA_FILE = "keys.dat"
+INDEX_FILE = "keys.idx"
+LOCK_FILE = "lock"
+
+INDEX_MAGIC = b"NTRI"
+INDEX_VERSION = 1
+
+INDEX_HEADER = np.dtype([("magic", "S4"), ("version", "<u1"), ("reserved", "V3"), ("sorted", "<u8"),
+                         ("unused", "V16")])
+ENTRY = np.dtype([("id", "<u8"), ("offset", "<u8"), ("successor", "<u8"), ("size", "<u4"), ("kind", "<u1"),
+                  ("reserved", "V3")])
+SUCCESSOR_OFFSET = ENTRY.fields["successor"][1]
+
+# Appends after which the index is sorted again (see KeyStore.reindex)
+MAX_UNSORTED = 4096
+
+# Number of key objects kept (with their precomputed tables) per store
+CACHE_SIZE = 16
+
+_HEX_DIGITS = frozenset(hexdigits)
+
+
+def fingerprint(params, h):
+    """
+    Return the fingerprint (64 hex digits) of the public key h with the parameters params.
+    """
+    digest = hashlib.sha256(b"NTRU key v1")
+    digest.update(np.array([params[name] for name in ("N", "p", "q", "d")], dtype="<u4").tobytes())
+    digest.update(compact.residues(h, params["q"]).astype("<u4").tobytes())
+    return digest.hexdigest()
+
+
+def key_id(fp):
+    """
+    Return the key ID (16 hex digits) of the fingerprint fp.
+    """
+    return fp[:16]
+
+
+def is_key_id(name):
+    """
+    Return True if name has the form of a key ID or of a fingerprint.
+    """
+    return isinstance(name, str) and len(name) in (16, 64) and _HEX_DIGITS.issuperset(name)
+
+
+def _id_value(key):
+    if not is_key_id(key):
+        raise KeyError("{!r} is not a key ID or fingerprint".format(key))
+    return int(key[:16], 16)
+
+
+class KeyStore:
+    """
+    A directory of key records with a memory mapped index, see the module documentation.
+    """
+
+    def __init__(self, path, create=True, cache_size=CACHE_SIZE):
+        """
+        INPUTS:
+        =======
+        path       : String, the store directory.
+        create     : Boolean, create an empty store if path holds none.
+        cache_size : Integer, the number of key objects kept (see encryptor).
+        """
+        self.path = os.path.abspath(path)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (kind, key ID) -> key object
+        self._lock = threading.RLock()
+        self._writers = 0  # depth of nested _StoreLock blocks of the thread holding _lock
+        self._index_stamp = None
+        self._data_size = -1
+        self._data = None
+        self._entries = np.zeros((0,), dtype=ENTRY)
+        self._sorted = 0
+
+        index = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index):
+            if not create:
+                raise FileNotFoundError("No key store in {}".format(self.path))
+            os.makedirs(self.path, exist_ok=True)
+            with self._writing():
+                if not os.path.exists(index):
+                    self._write_index(np.zeros((0,), dtype=ENTRY))
+                    open(os.path.join(self.path, DATA_FILE), "ab").close()
+        self._refresh()
+
+    def __len__(self):
+        self._refresh()
+        return len(self._entries)
+
+    def __contains__(self, key):
+        try:
+            self._find(key)
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        """
+        Return the key IDs of all keys in the store, in the order they were added.
+        """
+        self._refresh()
+        order = np.argsort(self._entries["offset"], kind="stable")
+        return ["{:016x}".format(i) for i in self._entries["id"][order]]
+
+    def info(self, key):
+        """
+        Return a dictionary describing the key (key ID or fingerprint): key_id, fingerprint,
+        kind ("pair" or "public"), params and successor (the key ID it was rotated to, or None).
+        """
+        entry = self._find(key)
+        with self._lock:
+            kind, params, arrays = self._decode(entry)
+        fp = fingerprint(params, arrays[0])
+        return {"key_id": key_id(fp), "fingerprint": fp, "kind": "pair" if kind == keyfile.PAIR else "public",
+                "params": params, "successor": "{:016x}".format(int(entry["successor"])) if entry["successor"] else None}
+
+    def current(self, key):
+        """
+        Return the key ID of the key that replaced key (by rotation), key itself if it was
+        never rotated.
+        """
+        entry = self._find(key)
+        seen = set()
+        while entry["successor"]:
+            if int(entry["id"]) in seen:
+                raise ValueError("Rotation cycle in key store {}".format(self.path))
+            seen.add(int(entry["id"]))
+            entry = self._find("{:016x}".format(int(entry["successor"])))
+        return "{:016x}".format(int(entry["id"]))
+
+    def encryptor(self, key, precompute=True):
+        """
+        Return an NTRUencrypt object for the key (key ID or fingerprint). Rotated keys cannot
+        encrypt anymore, use current(key) to find their replacement.
+        """
+        entry = self._find(key)
+        if entry["successor"]:
+            raise ValueError("Key {} was rotated to {:016x}".format(key, int(entry["successor"])))
+        return copy.copy(self._get("pub", entry, precompute))
+
+    def decryptor(self, key, precompute=True):
+        """
+        Return an NTRUdecrypt object for the key pair (key ID or fingerprint), rotated or not.
+        """
+        entry = self._find(key)
+        if entry["kind"] != keyfile.PAIR:
+            raise ValueError("Key {} has no private key in the store".format(key))
+        return copy.copy(self._get("priv", entry, precompute))
+
+    def add(self, key):
+        """
+        Append a key to the store and return its key ID. key is either an NTRUdecrypt object
+        holding a key pair, or an NTRUencrypt object with a public key read. Adding a key
+        that is already in the store returns its key ID without appending it again.
+        """
+        params = key.params() if isinstance(key, NTRUdecrypt) else {"N": key.N, "p": key.p, "q": key.q, "d": key.dr}
+        if isinstance(key, NTRUdecrypt):
+            kind, arrays = keyfile.PAIR, (key.h, key.f, key.fp, key.fq, key.g)
+        elif key.readKey:
+            kind, arrays = keyfile.PUBLIC, (key.h,)
+        else:
+            raise ValueError("Public key not read before adding it to the key store")
+        return self._append(kind, params, arrays)
+
+    def add_files(self, name):
+        """
+        Import the key files {name}.pub and, if it exists, {name}.priv (text or binary
+        format) into the store and return the key ID.
+        """
+        if os.path.exists(name + ".priv"):
+            D = NTRUdecrypt(logger, debug=False, check_time=False)
+            D.readPriv(name + ".priv")
+            D.readPub(name + ".pub")
+            return self.add(D)
+        E = NTRUencrypt()
+        E.readPub(name + ".pub")
+        return self.add(E)
+
+    def rotate(self, key, new):
+        """
+        Replace the key (key ID or fingerprint) by the new key (see add): new is appended and
+        becomes the successor of key. Return the key ID of new.
+        """
+        with self._writing():
+            old = self._find(key)
+            if old["successor"]:
+                raise ValueError("Key {} was already rotated to {:016x}".format(key, int(old["successor"])))
+            new_id = self.add(new)
+            if new_id == "{:016x}".format(int(old["id"])):
+                raise ValueError("Cannot rotate a key to itself")
+            position = self._position(old)
+            with open(os.path.join(self.path, INDEX_FILE), "r+b") as f:
+                f.seek(INDEX_HEADER.itemsize + position * ENTRY.itemsize + SUCCESSOR_OFFSET)
+                f.write(np.array(int(new_id, 16), dtype="<u8").tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._index_stamp = None
+            self._cache.pop(("pub", int(old["id"])), None)
+        return new_id
+
+    def reindex(self):
+        """
+        Rewrite the index sorted by key ID (atomically), so that every lookup is a binary search.
+        """
+        with self._writing():
+            self._refresh()
+            self._write_index(np.sort(self._entries, order="id", kind="stable"))
+            self._index_stamp = None
+            self._refresh()
+
+    def _writing(self):
+        return _StoreLock(self)
+
+    def _write_index(self, entries):
+        header = np.zeros((), dtype=INDEX_HEADER)
+        header["magic"] = INDEX_MAGIC
+        header["version"] = INDEX_VERSION
+        header["sorted"] = len(entries)
+        path = os.path.join(self.path, INDEX_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header.tobytes())
+            f.write(entries.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _refresh(self):
+        """
+        Map the index (again) if it was replaced or grew since it was last mapped.
+        """
+        path = os.path.join(self.path, INDEX_FILE)
+        st = os.stat(path)
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stamp == self._index_stamp:
+            return
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = np.frombuffer(buf, dtype=INDEX_HEADER, count=1)[0]
+        if header["magic"] != INDEX_MAGIC or header["version"] != INDEX_VERSION:
+            raise ValueError("{} is not a key store index".format(path))
+        # A torn entry left by an interrupted append is ignored
+        count = (len(buf) - INDEX_HEADER.itemsize) // ENTRY.itemsize
+        self._entries = np.frombuffer(buf, dtype=ENTRY, count=count, offset=INDEX_HEADER.itemsize)
+        self._sorted = min(int(header["sorted"]), count)
+        self._index_stamp = stamp
+
+    def _data_map(self, end):
+        # Map the data file again once it grew beyond the current map
+        if end > self._data_size:
+            with open(os.path.join(self.path, DATA_FILE), "rb") as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._data_size = len(self._data)
+        return self._data
+
+    def _lookup(self, value):
+        ids = self._entries["id"]
+        # Bisect on the mapped (strided) view directly, np.searchsorted would copy it first
+        sorted_ids = ids[:self._sorted]
+        start = bisect.bisect_left(sorted_ids, value)
+        stop = bisect.bisect_right(sorted_ids, value, lo=start)
+        tail = np.flatnonzero(ids[self._sorted:] == value) + self._sorted
+        return list(range(start, stop)) + tail.tolist()
+
+    def _find(self, key):
+        value = _id_value(key)
+        with self._lock:
+            self._refresh()
+            hits = self._lookup(value)
+            if len(hits) == 0:
+                # Appended by another process since the index was mapped
+                self._index_stamp = None
+                self._refresh()
+                hits = self._lookup(value)
+            entries = [self._entries[i] for i in hits]
+            if len(key) == 64:
+                # The index only holds key IDs, a fingerprint must match the record itself
+                entries = [e for e in entries if self._fingerprint(e) == key.lower()]
+            if len(entries) == 0:
+                raise KeyError("No key {} in key store {}".format(key, self.path))
+            if len(entries) > 1:
+                raise KeyError("Key ID {} is ambiguous, use the full fingerprint".format(key))
+            return entries[0]
+
+    def _position(self, entry):
+        return int(np.flatnonzero((self._entries["id"] == entry["id"]) & (self._entries["offset"] == entry["offset"]))[0])
+
+    def _fingerprint(self, entry):
+        _, params, arrays = self._decode(entry)
+        return fingerprint(params, arrays[0])
+
+    def _decode(self, entry):
+        offset = int(entry["offset"])
+        kind, params, arrays, _ = keyfile.unpack_key(self._data_map(offset + int(entry["size"])), offset)
+        return kind, params, arrays
+
+    def _get(self, kind, entry, precompute):
+        cache_key = (kind, int(entry["id"]))
+        with self._lock:
+            obj = self._cache.get(cache_key)
+            if obj is not None:
+                self._cache.move_to_end(cache_key)
+                return obj
+            _, params, arrays = self._decode(entry)
+
+        obj = _load(kind, params, arrays, precompute)
+        with self._lock:
+            self._cache[cache_key] = obj
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return obj
+
+    def _append(self, kind, params, arrays):
+        record = keyfile.pack_key(kind, params, arrays)
+        fp = fingerprint(params, arrays[0])
+        with self._writing():
+            if fp in self:
+                return key_id(fp)
+
+            with open(os.path.join(self.path, DATA_FILE), "ab") as f:
+                offset = f.tell()
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+
+            entry = np.zeros((), dtype=ENTRY)
+            entry["id"] = int(key_id(fp), 16)
+            entry["offset"] = offset
+            entry["size"] = len(record)
+            entry["kind"] = kind
+            path = os.path.join(self.path, INDEX_FILE)
+            with open(path, "r+b") as f:
+                # Drop a torn entry left by an interrupted append before adding ours
+                end = INDEX_HEADER.itemsize + len(self._entries) * ENTRY.itemsize
+                f.truncate(end)
+                f.seek(end)
+                f.write(entry.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._index_stamp = None
+            self._refresh()
+            if len(self._entries) - self._sorted > MAX_UNSORTED:
+                self.reindex()
+        return key_id(fp)
+
+
+class _StoreLock:
+    """
+    Serialise the writers of a store: threads through the store's lock, processes through
+    an exclusive lock on its lock file (where fcntl is available). Nested blocks of the same
+    thread only take the lock file once.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.file = None
+
+    def __enter__(self):
+        store = self.store
+        store._lock.acquire()
+        store._writers += 1
+        if store._writers > 1:
+            return self
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        try:
+            self.file = open(os.path.join(store.path, LOCK_FILE), "a")
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self.__exit__()
+            raise
+        # Another process may have appended while we waited
+        if os.path.exists(os.path.join(store.path, INDEX_FILE)):
+            store._index_stamp = None
+            store._refresh()
+        return self
+
+    def __exit__(self, *exc):
+        if self.file is not None:
+            self.file.close()  # releases the flock
+            self.file = None
+        self.store._writers -= 1
+        self.store._lock.release()
+        return False
+
+
+def _load(kind, params, arrays, precompute=True):
+    if kind == "pub":
+        obj = NTRUencrypt(N=params["N"], p=params["p"], q=params["q"], d=params["d"])
+        obj.h = arrays[0]
+        obj.readKey = True
+    else:
+        obj = NTRUdecrypt(logger, N=params["N"], p=params["p"], q=params["q"], df=params["df"], dg=params["dg"],
+                          d=params["d"], debug=False, check_time=False)
+        obj.h, obj.f, obj.fp, obj.fq, obj.g = arrays
+    if precompute:
+        obj.precompute()
+    return obj
+
+
+@functools.lru_cache(maxsize=None)
+def get_store(path):
+    """
+    Return the shared KeyStore for the directory path (opened, or created, on first use).
+    """
+    return KeyStore(path)
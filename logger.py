@@ -1,30 +1,51 @@
 import logging
-from colorama import Fore, Style, init
-from datetime import datetime
 
-# Initialize colorama for auto-resetting colors
-init(autoreset=True)
-
-# Define a color map for different logging levels
+# Define a color map (colorama.Fore names) for different logging levels
 COLOR_MAP = {
-    logging.DEBUG: Fore.CYAN,
-    logging.INFO: Fore.GREEN,
-    logging.WARNING: Fore.RED,
-    logging.ERROR: Fore.RED,
-    logging.CRITICAL: Fore.MAGENTA + Style.BRIGHT,  # Make critical bold
+    logging.DEBUG: "CYAN",
+    logging.INFO: "GREEN",
+    logging.WARNING: "RED",
+    logging.ERROR: "RED",
+    logging.CRITICAL: "MAGENTA",
 }
 
+# Levels written in bold
+BRIGHT_LEVELS = {logging.CRITICAL}  # Make critical bold
+
+# Escape codes per logging level, built from colorama on the first formatted message
+_colors = None
+
+
+def _load_colors():
+    # colorama is only imported (and initialised for auto-resetting colors) once something
+    # is actually logged, which keeps it out of the import time of the package
+    global _colors
+    from colorama import Fore, Style, init
+    init(autoreset=True)
+    _colors = {level: getattr(Fore, name) + (Style.BRIGHT if level in BRIGHT_LEVELS else "")
+               for level, name in COLOR_MAP.items()}
+    _colors[None] = Style.RESET_ALL
+    return _colors
+
 # Custom Formatter to colorize log messages
 class ColoredFormatter(logging.Formatter):
     def format(self, record):
-        log_color = COLOR_MAP.get(record.levelno, Style.RESET_ALL)
+        colors = _colors or _load_colors()
+        log_color = colors.get(record.levelno, colors[None])
         message = super().format(record)
-        return f"{log_color}{message}{Style.RESET_ALL}"
+        return f"{log_color}{message}{colors[None]}"
+
+# Log level of the timing messages written by CustomLogger.time
+TIME = 15
+logging.addLevelName(TIME, "TIME")
+COLOR_MAP[TIME] = "LIGHTBLACK_EX"
 
 # Custom Logger class that includes the time method
 class CustomLogger(logging.Logger):
     def time(self, data):
-        print(f"{Fore.LIGHTBLACK_EX}[TIME] {data}{Style.RESET_ALL}")
+        # Goes through the handlers (stderr) like every other message, never to stdout
+        if self.isEnabledFor(TIME):
+            self._log(TIME, data, ())
 
 # Create a logger and set up the colored formatter
 logger = CustomLogger(__name__)
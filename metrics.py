@@ -0,0 +1,256 @@
+"""
+Low overhead metrics: per-operation counters and latency histograms.
+
+Instrumented operations record their duration (time.perf_counter_ns) under a name such as
+    keygen.genfg, ring.inverse_mod_prime, ring.inverse_mod_pow2, ring.cyclic_mul, codec.pack,
+    encrypt.blocks, decrypt.string, key_io.read_priv
+and a few counters track volumes (e.g. encrypt.block_count, codec.bytes_encoded,
+codec.bytes_decoded). Metrics are
+disabled by default, a disabled instrumented call costs a single attribute check. Enable
+them with metrics.enable() or by setting the NTRU_METRICS environment variable.
+
+Hooks (add_hook) are called with (name, elapsed_ns) for every recorded duration, e.g. to
+feed an external profiler or tracing system. Nothing in this module writes to stdout.
+
+Usage:
+    import metrics
+    metrics.enable()
+    ntru.encrypt("key", "test")
+    print(metrics.snapshot()["histograms"]["encrypt.string"])
+"""
+import functools
+import os
+import threading
+import time
+
+# Durations are bucketed by their power of two in nanoseconds, bucket i holds durations
+# in [2^(i-1), 2^i) ns
+BUCKETS = 64
+
+
+class Histogram:
+    """
+    Latency histogram with power of two buckets.
+    """
+
+    __slots__ = ("count", "total_ns", "min_ns", "max_ns", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+        self.buckets = [0] * BUCKETS
+
+    def observe(self, ns):
+        self.count += 1
+        self.total_ns += ns
+        if self.min_ns is None or ns < self.min_ns:
+            self.min_ns = ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.buckets[min(ns.bit_length(), BUCKETS - 1)] += 1
+
+    def quantile(self, fraction):
+        """
+        Return an upper bound of the given quantile (e.g. 0.95), accurate to a factor 2.
+        """
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(1 << i, self.max_ns)
+        return self.max_ns
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "total_ns": self.total_ns,
+            "mean_ns": self.total_ns / self.count if self.count else None,
+            "min_ns": self.min_ns,
+            "max_ns": self.max_ns,
+            "p50_ns": self.quantile(0.5),
+            "p95_ns": self.quantile(0.95),
+            "p99_ns": self.quantile(0.99),
+            "buckets": {1 << i: n for i, n in enumerate(self.buckets) if n},
+        }
+
+
+class Registry:
+    """
+    Set of named counters and latency histograms, plus the hooks called on every recorded
+    duration.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._counters = {}
+        self._histograms = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, n=1):
+        """
+        Add n to the counter name.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, elapsed_ns):
+        """
+        Record a duration of elapsed_ns nanoseconds for the operation name.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(elapsed_ns)
+        for hook in self._hooks:
+            hook(name, elapsed_ns)
+
+    def add_hook(self, hook):
+        """
+        Call hook(name, elapsed_ns) for every recorded duration.
+        """
+        self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        self._hooks = [h for h in self._hooks if h is not hook]
+
+    def snapshot(self):
+        """
+        Return a copy of all counters and histograms as plain dictionaries.
+        """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {name: h.snapshot() for name, h in self._histograms.items()},
+            }
+
+    def reset(self):
+        """
+        Clear all counters and histograms (hooks are kept).
+        """
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+
+registry = Registry(enabled=bool(os.environ.get("NTRU_METRICS")))
+
+
+def enable():
+    registry.enabled = True
+
+
+def disable():
+    registry.enabled = False
+
+
+def enabled():
+    return registry.enabled
+
+
+def inc(name, n=1):
+    """ Add n to the counter name of the default registry """
+    registry.inc(name, n)
+
+
+def observe(name, elapsed_ns):
+    """ Record a duration for the operation name in the default registry """
+    registry.observe(name, elapsed_ns)
+
+
+def add_hook(hook):
+    """ Call hook(name, elapsed_ns) for every duration recorded in the default registry """
+    registry.add_hook(hook)
+
+
+def remove_hook(hook):
+    registry.remove_hook(hook)
+
+
+def snapshot():
+    """ Return the counters and histograms of the default registry """
+    return registry.snapshot()
+
+
+def reset():
+    registry.reset()
+
+
+def timed(name):
+    """
+    Decorator recording the duration of every call of the decorated function under name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(name, time.perf_counter_ns() - start)
+        return wrapper
+    return decorator
+
+
+class timer:
+    """
+    Context manager recording the duration of its block under name.
+    """
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if registry.enabled:
+            self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            registry.observe(self.name, time.perf_counter_ns() - self.start)
+        return False
+
+
+def export_json(snap=None):
+    """
+    Return a snapshot (the current one by default) as a JSON string.
+    """
+    import json
+    return json.dumps(snap or snapshot(), indent=2)
+
+
+def export_prometheus(snap=None, prefix="ntru"):
+    """
+    Return a snapshot (the current one by default) in the Prometheus text exposition format.
+    """
+    snap = snap or snapshot()
+    lines = []
+    for name, value in sorted(snap["counters"].items()):
+        metric = "{}_{}_total".format(prefix, name.replace(".", "_"))
+        lines += ["# TYPE {} counter".format(metric), "{} {}".format(metric, value)]
+    for name, h in sorted(snap["histograms"].items()):
+        metric = "{}_{}_seconds".format(prefix, name.replace(".", "_"))
+        lines.append("# TYPE {} histogram".format(metric))
+        seen = 0
+        for bound, n in sorted(h["buckets"].items()):
+            seen += n
+            lines.append('{}_bucket{{le="{:.9g}"}} {}'.format(metric, bound / 1e9, seen))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, h["count"]))
+        lines.append("{}_sum {:.9g}".format(metric, h["total_ns"] / 1e9))
+        lines.append("{}_count {}".format(metric, h["count"]))
+    return "\n".join(lines) + "\n"
@@ -1,9 +1,11 @@
 import time
 import numpy as np
+import codec
 from logger import logger
-from NTRUencrypt import NTRUencrypt
 from NTRUdecrypt import NTRUdecrypt
 from utils import factor_int
+from keycache import default_keyring
+from stream import StreamEncryptor, StreamDecryptor, CHUNK_SIZE
 
 
 # Constants for N, p, q, df, dg, d parameter sets
@@ -39,16 +41,39 @@ This is from Wikipedia: https://en.wikipedia.org/wiki/NTRUEncrypt#Table_1:_Param
 """
 
 
+# Optional keypool.KeyPool used by generate_keys when no pool is passed explicitly
+key_pool = None
+
+# Optional keystore.KeyStore (or the path of its directory): when set, key names of the form
+# of a key ID or fingerprint (see keystore.is_key_id) are looked up in it instead of in
+# {name}.pub / {name}.priv key files
+key_store = None
+
+
+def __getattr__(name):
+    # Load the asyncio facade (ntru.aio) on first access only
+    if name == "aio":
+        import aio
+        return aio
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def generate_keys(name: str = "key", mode: str = "highest", skip_check: bool = False, debug: bool = False,
-                  check_time: bool = False) -> None:
+                  check_time: bool = False, binary: bool = False, pool=None, store=None):
     """
     Generate a pair of public and private keys using NTRU encryption.
 
-    :param name: name of the key file to output
+    :param name: name of the key file to output (unused when the keys go to a key store)
     :param mode: the security mode to use - "moderate", "high", or "highest"
     :param skip_check: whether to skip the security factor check
     :param debug: whether to enable verbose logger
     :param check_time: whether to log the duration of each step
+    :param binary: whether to write the key files in the binary key format
+    :param pool: KeyPool to take a ready key pair from, defaults to the module level key_pool;
+                 keys are generated on the spot if it has none ready for mode
+    :param store: KeyStore (or the path of its directory) to add the key pair to, instead of
+                  writing key files
+    :return: the key ID of the key pair in the store, or None when key files are written
     """
     if mode not in PARAM_SETS:
         raise ValueError("Mode must be 'moderate', 'high', or 'highest'")
@@ -57,13 +82,28 @@ def generate_keys(name: str = "key", mode: str = "highest", skip_check: bool = F
     if debug:
         logger.info("Starting key generation in %s mode", mode)
 
-    N1 = NTRUdecrypt(logger, debug=debug, check_time=check_time)
-    N1.setNpq(**params)
+    pool = pool or key_pool
+    N1 = pool.take(mode) if pool is not None else None
+    store = _store(store)
 
     start_time = time.time() if check_time else None
     step_start = time.time() if check_time else None
-    logger.info("Generating public and private keys")
-    N1.genPubPriv(name)
+    key_id = None
+    if N1 is not None:
+        N1.debug, N1.check_time = debug, check_time
+    else:
+        N1 = NTRUdecrypt(logger, debug=debug, check_time=check_time)
+        N1.setNpq(**params)
+        logger.info("Generating public and private keys")
+        N1.genfg()
+        N1.genh()
+    if store is not None:
+        key_id = store.add(N1)
+        logger.info("Added key pair %s to the key store", key_id)
+    else:
+        logger.info("Writing public and private keys")
+        N1.writePub(name, binary)
+        N1.writePriv(name, binary)
     if check_time:
         elapsed = time.time() - step_start
         logger.info(f"Key generation took {elapsed:.4f} seconds")
@@ -92,6 +132,7 @@ def generate_keys(name: str = "key", mode: str = "highest", skip_check: bool = F
     if check_time:
         total_elapsed = time.time() - start_time
         logger.info(f"Total key generation process took {total_elapsed:.4f} seconds")
+    return key_id
 
 
 def security_check(N1: NTRUdecrypt) -> bool:
@@ -101,7 +142,7 @@ def security_check(N1: NTRUdecrypt) -> bool:
     :param N1: the NTRUdecrypt object containing the parameters
     :return: True if the key passes security checks, False otherwise
     """
-    factors = factor_int(N1.h[-1])
+    factors = factor_int(int(N1.h[-1]))
     possible_keys = (2 ** N1.df * (N1.df + 1) ** 2 *
                      2 ** N1.dg * (N1.dg + 1) *
                      2 ** N1.dr * (N1.dr + 1))
@@ -112,50 +153,279 @@ def security_check(N1: NTRUdecrypt) -> bool:
     return len(factors) == 0 and possible_keys > 2 ** 80
 
 
-def encrypt(name: str, message: str, check_time: bool = False) -> str:
+def _store(store):
+    """
+    Return the KeyStore for store (a KeyStore or the path of its directory), or None.
+    """
+    if store is None or not isinstance(store, str):
+        return store
+    import keystore
+    return keystore.get_store(store)
+
+
+def _encryptor(name: str, precompute: bool = True):
+    """
+    Return an NTRUencrypt object for the key name, from the key store if it is a key ID.
+    """
+    store = _store(key_store)
+    if store is not None:
+        import keystore
+        if keystore.is_key_id(name):
+            return store.encryptor(name, precompute)
+    return default_keyring.encryptor(f"{name}.pub", precompute=precompute)
+
+
+def _decryptor(name: str):
+    """
+    Return an NTRUdecrypt object for the key name, from the key store if it is a key ID.
+    """
+    store = _store(key_store)
+    if store is not None:
+        import keystore
+        if keystore.is_key_id(name):
+            return store.decryptor(name)
+    return default_keyring.decryptor(f"{name}.priv")
+
+
+def _encoding(dense: bool) -> int:
+    """
+    Map the dense flag of the encryption functions onto a codec message encoding.
+    """
+    return codec.ENCODING_TERNARY if dense else codec.ENCODING_BITS
+
+
+def encrypt(name: str, message: str, check_time: bool = False, workers: int = 1, dense: bool = False,
+            hybrid: bool = False) -> str:
     """
     Encrypt a message using the public key.
 
-    :param name: name of the key file
+    :param name: name of the key file, or a key ID or fingerprint in the key store (see key_store)
     :param message: plaintext message to encrypt
     :param check_time: whether to log the duration of the encryption process
+    :param workers: number of processes to spread the message blocks over
+    :param dense: encode the message as balanced ternary digits (about 37% fewer blocks)
+    :param hybrid: encrypt only a session key with NTRU and the message with a symmetric cipher
+                   (see hybrid.py), recommended for messages over a few KB
     :return: encrypted message
     """
     logger.info("Encrypting message with key: %s", name)
     start_time = time.time()
 
-    E = NTRUencrypt()
-    E.readPub(f"{name}.pub")
-    E.encryptString(message)
+    E = _encryptor(name)
+    if hybrid:
+        import hybrid as hybrid_mode
+        cipher = hybrid_mode.to_text(hybrid_mode.encrypt(E, message))
+    else:
+        E.encryptString(message, workers, _encoding(dense))
+        cipher = E.Me
 
     if check_time:
         elapsed = time.time() - start_time
         logger.info(f"Encryption took {elapsed:.4f} seconds")
 
-    return E.Me
+    return cipher
 
 
-def decrypt(name: str, cipher: str, check_time: bool = False) -> str:
+def encrypt_many(keys, message: str, check_time: bool = False, dense: bool = False) -> list:
+    """
+    Encrypt the same message for many recipients at once, one ciphertext per public key.
+
+    The message is encoded once per ring size, and the recipients are grouped by parameter
+    set and encrypted in batched passes (see batch.py).
+
+    :param keys: names of the key files (or key IDs in the key store) of the recipients
+    :param message: plaintext message to encrypt
+    :param check_time: whether to log the duration of the encryption process
+    :param dense: encode the message as balanced ternary digits (about 37% fewer blocks)
+    :return: list of encrypted messages (as returned by encrypt), in the order of keys
+    """
+    import batch
+
+    keys = list(keys)
+    logger.info("Encrypting message for %d keys", len(keys))
+    start_time = time.time()
+
+    encryptors = [_encryptor(name, precompute=False) for name in keys]
+    groups = {}
+    for i, E in enumerate(encryptors):
+        groups.setdefault(batch.params_key(E), []).append(i)
+
+    encoded = {}
+    ciphers = [None] * len(keys)
+    for (N, _, _, _), members in groups.items():
+        if N not in encoded:
+            encoded[N] = codec.encode_message(message, N, _encoding(dense))
+        encrypted = batch.encrypt_blocks_many([encryptors[i] for i in members], encoded[N])
+        for i, E in zip(members, encrypted):
+            ciphers[i] = " ".join(map(str, E.ravel().tolist()))
+
+    if check_time:
+        elapsed = time.time() - start_time
+        logger.info(f"Encryption for {len(keys)} keys took {elapsed:.4f} seconds")
+
+    return ciphers
+
+
+def decrypt(name: str, cipher: str, check_time: bool = False, workers: int = 1) -> str:
     """
     Decrypt a message using the private key.
 
-    :param name: name of the key file
+    :param name: name of the key file, or a key ID or fingerprint in the key store (see key_store)
     :param cipher: encrypted message to decrypt
     :param check_time: whether to log the duration of the decryption process
+    :param workers: number of processes to spread the ciphertext blocks over
     :return: decrypted message
+    :raises ValueError: if cipher is malformed or was not encrypted with this key
     """
     logger.info("Decrypting message with key: %s", name)
     start_time = time.time()
 
-    D = NTRUdecrypt()
-    D.readPriv(f"{name}.priv")
-    D.decryptString(cipher)
+    D = _decryptor(name)
+    if cipher.startswith(codec.HYBRID_TEXT_PREFIX):
+        import hybrid as hybrid_mode
+        container = hybrid_mode.from_text(cipher)
+        message = hybrid_mode.decrypt(D, container).decode("utf-8", errors="ignore")
+    else:
+        D.decryptString(cipher, workers)
+        message = D.M
+
+    if check_time:
+        elapsed = time.time() - start_time
+        logger.info(f"Decryption took {elapsed:.4f} seconds")
+
+    return message
+
+
+def decrypt_many(name: str, ciphertexts, check_time: bool = False) -> list:
+    """
+    Decrypt many independent ciphertexts with the same private key in one batched pass.
+
+    Text ciphertexts (as returned by encrypt) decrypt to str, packed ciphertexts (as returned
+    by encrypt_bytes) to bytes. A ciphertext that fails does not abort the others.
+
+    :param name: name of the key file, or a key ID or fingerprint in the key store (see key_store)
+    :param ciphertexts: iterable of ciphertexts to decrypt
+    :param check_time: whether to log the duration of the decryption process
+    :return: list of batch.DecryptResult(plaintext, error) tuples, in the order of ciphertexts;
+             error is None on success, otherwise the exception and plaintext is None
+    """
+    import batch
+
+    logger.info("Decrypting many messages with key: %s", name)
+    start_time = time.time()
+
+    results = batch.decrypt_many(_decryptor(name), ciphertexts)
+
+    if check_time:
+        elapsed = time.time() - start_time
+        logger.info(f"Decryption of {len(results)} messages took {elapsed:.4f} seconds")
+
+    return results
+
+
+def encrypt_bytes(name: str, data: bytes, check_time: bool = False, workers: int = 1, dense: bool = False,
+                  hybrid: bool = False) -> bytes:
+    """
+    Encrypt raw bytes using the public key, returning a packed binary ciphertext.
+
+    :param name: name of the key file, or a key ID or fingerprint in the key store (see key_store)
+    :param data: plaintext bytes to encrypt
+    :param check_time: whether to log the duration of the encryption process
+    :param workers: number of processes to spread the message blocks over
+    :param dense: encode the data as balanced ternary digits (about 37% fewer blocks)
+    :param hybrid: encrypt only a session key with NTRU and the data with a symmetric cipher
+                   (see hybrid.py), recommended for data over a few KB
+    :return: packed ciphertext (see codec.py), or hybrid container if hybrid is set
+    """
+    logger.info("Encrypting %d bytes with key: %s", len(data), name)
+    start_time = time.time()
+
+    E = _encryptor(name)
+    if hybrid:
+        import hybrid as hybrid_mode
+        cipher = hybrid_mode.encrypt(E, data)
+    else:
+        encoding = _encoding(dense)
+        blocks = codec.bytes_to_blocks(data, E.N, encoding)
+        if workers > 1:
+            # The workers pack their own blocks, see parallel.py
+            from parallel import encrypt_packed
+            cipher = codec.pack_header(E.N, E.q, len(blocks), len(data), encoding) + \
+                encrypt_packed(E, blocks, workers)
+        else:
+            cipher = codec.pack_ciphertext(E.encryptBlocks(blocks), E.q, len(data), encoding)
+
+    if check_time:
+        elapsed = time.time() - start_time
+        logger.info(f"Encryption took {elapsed:.4f} seconds")
+
+    return cipher
+
+
+def decrypt_bytes(name: str, cipher: bytes, check_time: bool = False, workers: int = 1) -> bytes:
+    """
+    Decrypt a packed binary ciphertext or hybrid container (as returned by encrypt_bytes)
+    using the private key.
+
+    :param name: name of the key file, or a key ID or fingerprint in the key store (see key_store)
+    :param cipher: packed ciphertext or hybrid container to decrypt
+    :param check_time: whether to log the duration of the decryption process
+    :param workers: number of processes to spread the ciphertext blocks over
+    :return: decrypted bytes
+    """
+    logger.info("Decrypting %d bytes with key: %s", len(cipher), name)
+    start_time = time.time()
+
+    D = _decryptor(name)
+    if codec.is_hybrid(cipher):
+        import hybrid as hybrid_mode
+        data = hybrid_mode.decrypt(D, cipher)
+    else:
+        header = codec.read_header(cipher)
+        if (header["N"], header["q"]) != (D.N, D.q):
+            raise ValueError("Ciphertext parameters N={}, q={} do not match the key".format(header["N"], header["q"]))
+        if workers > 1:
+            # The workers unpack their own blocks, see parallel.py
+            from parallel import decrypt_packed
+            decrypted = decrypt_packed(D, *codec.split_ciphertext(cipher), workers)
+        else:
+            decrypted = D.decryptBlocks(codec.unpack_ciphertext(cipher)[1])
+        data = codec.blocks_to_bytes(decrypted, header["length"], header["encoding"])
 
     if check_time:
         elapsed = time.time() - start_time
         logger.info(f"Decryption took {elapsed:.4f} seconds")
 
-    return D.M
+    return data
+
+
+def encrypt_file(name: str, src, dst, chunk_size: int = CHUNK_SIZE, dense: bool = False) -> int:
+    """
+    Encrypt a binary stream chunk by chunk using the public key, with bounded memory.
+
+    :param name: name of the key file, or a key ID or fingerprint in the key store (see key_store)
+    :param src: binary file-like object (or iterable of bytes) to encrypt
+    :param dst: binary file-like object the ciphertext frames are written to
+    :param chunk_size: number of plaintext bytes encrypted per frame
+    :param dense: encode the data as balanced ternary digits (about 37% fewer blocks)
+    :return: number of ciphertext bytes written
+    """
+    logger.info("Encrypting stream with key: %s", name)
+    E = _encryptor(name)
+    return StreamEncryptor(E, chunk_size, _encoding(dense)).encrypt_file(src, dst)
+
+
+def decrypt_file(name: str, src, dst) -> int:
+    """
+    Decrypt a stream written by encrypt_file using the private key, with bounded memory.
+
+    :param name: name of the key file, or a key ID or fingerprint in the key store (see key_store)
+    :param src: binary file-like object (or iterable of bytes) holding the ciphertext frames
+    :param dst: binary file-like object the plaintext is written to
+    :return: number of plaintext bytes written
+    """
+    logger.info("Decrypting stream with key: %s", name)
+    return StreamDecryptor(_decryptor(name)).decrypt_file(src, dst)
 
 
 def check_key_sparsity(f, threshold=5):
@@ -0,0 +1,259 @@
+"""
+Multi-core encryption and decryption of many message blocks.
+
+The blocks are split into contiguous ranges that are processed by a pool of worker
+processes and reassembled in order. Besides the block arithmetic, the workers also do the
+serialisation of their range: they join their encrypted blocks into the text ciphertext
+format or pack them (see codec.pack_coeffs), and parse or unpack their part of a
+ciphertext, so that the parent only splits the input and concatenates the results.
+
+The key material is sent to every worker once, when its pool starts, and the pools are
+kept for reuse (one per key and number of workers, see POOL_CACHE_SIZE). Every range
+draws its blinding polynomials from its own independent random stream (spawned from a
+single numpy SeedSequence).
+"""
+import atexit
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import codec
+import compact
+
+# Number of worker pools kept alive for reuse, the least recently used one is shut down
+POOL_CACHE_SIZE = 4
+
+# The key object of the current worker process, set by _init_worker
+_key = None
+
+_pools = OrderedDict()  # (kind, params, key bytes, workers) -> ProcessPoolExecutor
+_pools_lock = threading.Lock()
+
+
+def _init_worker(kind, params, arrays):
+    global _key
+    if kind == "pub":
+        from NTRUencrypt import NTRUencrypt
+
+        _key = NTRUencrypt(N=params["N"], p=params["p"], q=params["q"], d=params["d"])
+        _key.h = arrays[0]
+        _key.readKey = True
+    else:
+        from NTRUdecrypt import NTRUdecrypt
+        from logger import logger
+
+        _key = NTRUdecrypt(logger, N=params["N"], p=params["p"], q=params["q"], d=params["d"],
+                           debug=False, check_time=False)
+        _key.f, _key.fp = arrays
+    _key.precompute()
+
+
+def _encrypt_range(B, seed):
+    return _key.encryptBlocks(B, rng=np.random.default_rng(seed))
+
+
+def _encrypt_text_range(B, seed):
+    return " ".join(map(str, _encrypt_range(B, seed).ravel().tolist()))
+
+
+def _encrypt_packed_range(B, seed):
+    return codec.pack_coeffs(_encrypt_range(B, seed), _key.q)
+
+
+def _decrypt_range(E):
+    return _key.decryptBlocks(E)
+
+
+def _decrypt_text_range(text):
+    Me = np.fromstring(text, dtype=int, sep=" ")
+    if len(Me) % _key.N != 0:
+        # The range does not hold whole blocks, see decrypt_text
+        return None
+    return _decrypt_range(Me.reshape(-1, _key.N))
+
+
+def _decrypt_packed_range(payload, blocks):
+    E = codec.unpack_coeffs(payload, blocks * _key.N, _key.q)
+    E[E > _key.q // 2] -= _key.q
+    return _decrypt_range(E.reshape(blocks, _key.N))
+
+
+def _pool(kind, key, workers):
+    """
+    Return a worker pool holding the public (kind "pub") or private (kind "priv") key of
+    the key object key, started on first use and kept for reuse.
+    """
+    params = {"N": key.N, "p": key.p, "q": key.q, "d": key.dr}
+    arrays = (np.asarray(key.h),) if kind == "pub" else (np.asarray(key.f), np.asarray(key.fp))
+    cache_key = (kind, tuple(params.values()), b"".join(a.tobytes() for a in arrays), workers)
+    with _pools_lock:
+        pool = _pools.get(cache_key)
+        if pool is not None:
+            _pools.move_to_end(cache_key)
+            return pool
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(kind, params, arrays))
+        _pools[cache_key] = pool
+        while len(_pools) > POOL_CACHE_SIZE:
+            # Work already submitted to an evicted pool still completes
+            _pools.popitem(last=False)[1].shutdown(wait=False)
+    return pool
+
+
+def shutdown():
+    """
+    Shut down all worker pools kept for reuse.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+
+atexit.register(shutdown)
+
+
+def _ranges(count, parts, align=1):
+    """
+    Split range(count) into at most parts contiguous (start, stop) ranges of about equal
+    size, with every boundary at a multiple of align.
+    """
+    bounds = sorted({min(count, -(-count * i // parts // align) * align) for i in range(parts + 1)})
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if stop > start]
+
+
+def _split_blocks(B, workers, align=1):
+    B = np.asarray(B)
+    return [compact.narrow(B[start:stop]) for start, stop in _ranges(len(B), workers, align)]
+
+
+def encrypt_blocks(encryptor, B, workers, seed=None):
+    """
+    Encrypt the message blocks B (shape (blocks, N)) with encryptor.encryptBlocks, spread
+    over a pool of worker processes.
+
+    INPUTS:
+    =======
+    encryptor : NTRUencrypt object with the public key read.
+    B         : Integer array of shape (blocks, N), the message blocks.
+    workers   : Integer, the number of worker processes.
+    seed      : Optional seed for the numpy SeedSequence the random streams are spawned from,
+                fresh OS entropy is used if None.
+
+    RETURNS:
+    ========
+    The encrypted blocks as an integer array of shape (blocks, N).
+    """
+    ranges = _split_blocks(B, workers)
+    seeds = np.random.SeedSequence(seed).spawn(len(ranges))
+    return np.concatenate(list(_pool("pub", encryptor, workers).map(_encrypt_range, ranges, seeds)))
+
+
+def encrypt_text(encryptor, B, workers, seed=None):
+    """
+    Encrypt the message blocks B like encrypt_blocks, and return the encrypted blocks in the
+    text ciphertext format (coefficients separated by single spaces, see
+    NTRUencrypt.encryptString), every worker formatting its own range.
+    """
+    ranges = _split_blocks(B, workers)
+    seeds = np.random.SeedSequence(seed).spawn(len(ranges))
+    return " ".join(_pool("pub", encryptor, workers).map(_encrypt_text_range, ranges, seeds))
+
+
+def encrypt_packed(encryptor, B, workers, seed=None):
+    """
+    Encrypt the message blocks B like encrypt_blocks, and return the encrypted blocks packed
+    by codec.pack_coeffs (the packed ciphertext without its header), every worker packing
+    its own range.
+    """
+    # Ranges of a multiple of 8 blocks fill whole bytes, so the packed ranges can be joined
+    ranges = _split_blocks(B, workers, align=8)
+    seeds = np.random.SeedSequence(seed).spawn(len(ranges))
+    return b"".join(_pool("pub", encryptor, workers).map(_encrypt_packed_range, ranges, seeds))
+
+
+def decrypt_blocks(decryptor, E, workers):
+    """
+    Decrypt the encrypted blocks E (shape (blocks, N)) with decryptor.decryptBlocks, spread
+    over a pool of worker processes.
+
+    INPUTS:
+    =======
+    decryptor : NTRUdecrypt object with the private key read.
+    E         : Integer array of shape (blocks, N), the encrypted blocks.
+    workers   : Integer, the number of worker processes.
+
+    RETURNS:
+    ========
+    The decrypted message blocks as an integer array of shape (blocks, N).
+    """
+    ranges = _split_blocks(E, workers)
+    return np.concatenate(list(_pool("priv", decryptor, workers).map(_decrypt_range, ranges)))
+
+
+def _split_text(E, N, parts):
+    """
+    Split the text ciphertext E into at most parts slices of whole blocks of N coefficients,
+    assuming the coefficients are separated by single spaces.
+    """
+    E = E.strip()
+    slices = []
+    start = tokens = 0
+    for i in range(1, parts):
+        pos = E.find(" ", max(start, len(E) * i // parts))
+        if pos < 0:
+            break
+        # Number of coefficients before pos, moved on to the next block boundary
+        tokens += E.count(" ", start, pos) + 1
+        while tokens % N and pos >= 0:
+            pos = E.find(" ", pos + 1)
+            tokens += 1
+        if pos < 0:
+            break
+        slices.append(E[start:pos])
+        start = pos + 1
+    slices.append(E[start:])
+    return slices
+
+
+def decrypt_text(decryptor, E, workers):
+    """
+    Parse and decrypt the text ciphertext E (as written by encrypt_text), every worker
+    parsing and decrypting its own slice of whole blocks.
+
+    RETURNS:
+    ========
+    The decrypted message blocks as an integer array of shape (blocks, N).
+    """
+    N = decryptor.N
+    results = list(_pool("priv", decryptor, workers).map(_decrypt_text_range, _split_text(E, N, workers)))
+    if any(M is None for M in results):
+        # Other separators than single spaces put a slice boundary inside a block, parse the
+        # whole ciphertext here instead
+        Me = np.fromstring(E, dtype=int, sep=" ")
+        if len(Me) % N != 0:
+            raise ValueError("Input decrypt string is not integer multiple of N")
+        return decrypt_blocks(decryptor, Me.reshape(-1, N), workers)
+    return np.concatenate(results)
+
+
+def decrypt_packed(decryptor, header, payload, workers):
+    """
+    Unpack and decrypt the coefficients payload of a packed ciphertext with the given header
+    (see codec.split_ciphertext), every worker unpacking and decrypting its own range.
+
+    RETURNS:
+    ========
+    The decrypted message blocks as an integer array of shape (blocks, N).
+    """
+    nbits = codec.coeff_bits(header["q"])
+    blocks, N = header["blocks"], header["N"]
+    if len(payload) * 8 < blocks * N * nbits:
+        raise ValueError("Packed ciphertext is truncated")
+    ranges = _ranges(blocks, workers, align=8)
+    # Ranges of a multiple of 8 blocks start on a byte boundary of the payload
+    payloads = [bytes(payload[start * N * nbits // 8:-(-stop * N * nbits // 8)]) for start, stop in ranges]
+    counts = [stop - start for start, stop in ranges]
+    return np.concatenate(list(_pool("priv", decryptor, workers).map(_decrypt_packed_range, payloads, counts)))
@@ -0,0 +1,545 @@
+"""
+Arithmetic in the NTRU polynomial ring Z[x]/(x^N - 1) on fixed-length integer arrays.
+
+Polynomials follow the same convention as the rest of the code base (and sympy's
+all_coeffs()): an array of length N holding the coefficients from the highest degree
+down to the constant term, i.e.
+    x^4 + 5x^2 + 3 == [1,0,5,0,3]
+
+Everything that only depends on the parameters (N, p, q) is validated and computed once per
+parameter set and shared through the RingContext returned by context(N, p, q).
+
+Products are computed by one of several backends, chosen per product by select_backend from
+the size and density of the operands (or forced with the backend argument):
+    "sparse"    : sum of rotations selected by a sparse ternary operand, O(weight * N)
+    "convolve"  : np.convolve, O(N^2) but without overhead for small N
+    "karatsuba" : Karatsuba splitting down to np.convolve, O(N^1.58)
+    "fft"       : float64 FFT convolution, O(N log N), only used when fft_exact proves
+                  that rounding the result gives the exact integer product
+"""
+import functools
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import metrics
+
+# Ternary operands with at most this fraction of non-zero coefficients are multiplied
+# with the sparse kernel, denser ones with the ordinary convolution
+SPARSE_DENSITY = 0.6
+
+# Dense products of operands with fewer coefficients than this are left to np.convolve
+FFT_MIN_N = 128
+
+# Karatsuba recursion stops at operands of at most this many coefficients
+KARATSUBA_BASE = 256
+
+# Largest error bound of fft_mul accepted as exact: the result is rounded to the nearest
+# integer, so anything below 1/2 would do, the margin covers differences between the
+# analysed FFT and numpy's implementation
+FFT_MAX_ERROR = 1 / 16
+
+# Relative error of float64 arithmetic and (assumed) of the FFT twiddle factors
+_EPS = 2.0 ** -53
+_TWIDDLE_EPS = 2.0 ** -52
+
+BACKENDS = ("sparse", "convolve", "karatsuba", "fft")
+
+
+def is_prime(n):
+    """
+    Return True if the integer n is prime (trial division up to sqrt(n), cached).
+    """
+    return _is_prime(int(n))
+
+
+@functools.lru_cache(maxsize=None)
+def _is_prime(n):
+    if n < 2:
+        return False
+    for d in range(2, math.isqrt(n) + 1):
+        if n % d == 0:
+            return False
+    return True
+
+
+def is_pow2(n):
+    """
+    Return True if the integer n is a power of two.
+    """
+    return n > 0 and n & (n - 1) == 0
+
+
+@functools.lru_cache(maxsize=8)
+def rotation_index(N):
+    """
+    Return the (read-only) N x N index matrix idx with idx[i, j] = (j - i - 1) mod N, which
+    turns a polynomial b into its circulant matrix b[idx] (see circulant).
+    """
+    idx = (np.arange(N)[None, :] - np.arange(N)[:, None] - 1) % N
+    idx.flags.writeable = False
+    return idx
+
+
+class RingContext:
+    """
+    Immutable, validated parameters N, p, q of the ring Z[x]/(x^N - 1), together with the
+    data derived from them:
+        I         : the ideal x^N - 1 as a read-only array of N+1 coefficients
+        p_prime   : True if p is prime (inverses mod p by extended Euclid)
+        p_mask    : p - 1 if p is a power of two (inverses mod p by Newton lifting), else None
+        q_prime   : True if q is prime
+        q_mask    : q - 1 if q is a power of two, else None
+    so that inverting polynomials (see utils.poly_inv) needs no primality test per call.
+    Obtain instances with context(N, p, q), which shares one instance per parameter set.
+    """
+
+    __slots__ = ("N", "p", "q", "I", "p_prime", "p_mask", "q_prime", "q_mask")
+
+    def __init__(self, N, p, q):
+        N, p, q = int(N), int(p), int(q)
+        if not is_prime(N):
+            raise ValueError("N must be prime, got {}".format(N))
+        if p < 2 or q < 2 or math.gcd(p, q) != 1:
+            raise ValueError("p and q must be coprime integers >= 2, got p={}, q={}".format(p, q))
+
+        I = np.zeros((N + 1,), dtype=np.int8)
+        I[N] = -1
+        I[0] = 1
+        I.flags.writeable = False
+
+        for name, value in (("N", N), ("p", p), ("q", q), ("I", I),
+                            ("p_prime", is_prime(p)), ("p_mask", p - 1 if is_pow2(p) else None),
+                            ("q_prime", is_prime(q)), ("q_mask", q - 1 if is_pow2(q) else None)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RingContext objects are immutable")
+
+    def __repr__(self):
+        return "RingContext(N={}, p={}, q={})".format(self.N, self.p, self.q)
+
+    def modulus(self, m):
+        """
+        Return (prime, mask) for the modulus m, which must be p or q: whether m is prime, and
+        m - 1 if m is a power of two else None.
+        """
+        if m == self.p:
+            return self.p_prime, self.p_mask
+        if m == self.q:
+            return self.q_prime, self.q_mask
+        raise ValueError("{} is neither p nor q of {!r}".format(m, self))
+
+
+@functools.lru_cache(maxsize=None)
+def _context(N, p, q):
+    return RingContext(N, p, q)
+
+
+def context(N, p, q):
+    """
+    Return the shared RingContext for the parameters N, p, q (created on first use).
+    """
+    return _context(int(N), int(p), int(q))
+
+
+def to_ring(a, N):
+    """
+    Return the polynomial a as an int64 array of exactly N coefficients.
+
+    Arrays shorter than N are padded with leading zeros (as written by sympy's
+    all_coeffs(), which strips them), longer arrays are folded modulo x^N - 1.
+    """
+    a = np.asarray(a, dtype=np.int64)
+    if len(a) < N:
+        return np.pad(a, (N - len(a), 0), constant_values=0)
+    if len(a) > N:
+        return fold(a, N)
+    return a
+
+
+def fold(a, N):
+    """
+    Reduce the polynomial a (of any degree) modulo x^N - 1, i.e. add the coefficient of
+    x^k onto x^(k mod N).
+    """
+    a = np.asarray(a, dtype=np.int64)
+    pad = -len(a) % N
+    if pad:
+        a = np.pad(a, (pad, 0), constant_values=0)
+    return a.reshape(-1, N).sum(axis=0)
+
+
+def fft_error_bound(a, b):
+    """
+    Return an upper bound of the largest absolute error of the coefficients of fft_mul(a, b)
+    before rounding.
+
+    The bound is the one proven for floating point FFT convolution by C. Percival, "Rapid
+    multiplication modulo the sum and difference of highly composite numbers", Math. Comp.
+    72 (2003), for a transform of length 2^k:
+        |error| <= |a| |b| ((1 + e)^3k (1 + e sqrt(5))^(3k + 1) (1 + t)^3k - 1)
+    with |.| the Euclidean norm, e the float64 rounding error and t that of the twiddle
+    factors. If a has several rows the largest norm of a row is used.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    k = (a.shape[-1] + b.shape[-1] - 2).bit_length()
+    norm = float(np.sqrt(np.square(a).sum(axis=-1)).max(initial=0)) * float(np.sqrt(np.square(b).sum()))
+    growth = math.expm1(3 * k * math.log1p(_EPS) + (3 * k + 1) * math.log1p(_EPS * math.sqrt(5))
+                        + 3 * k * math.log1p(_TWIDDLE_EPS))
+    return norm * growth
+
+
+def fft_exact(a, b):
+    """
+    Return True if fft_mul(a, b) is provably the exact product of a and b (see fft_error_bound).
+    """
+    return fft_error_bound(a, b) < FFT_MAX_ERROR
+
+
+def select_backend(a, b, cyclic=True):
+    """
+    Return the name of the fastest backend (see BACKENDS) that computes the product of the
+    polynomials a and b exactly. The sparse kernel only computes cyclic products, it is
+    not considered unless cyclic is True.
+    """
+    if cyclic and (is_sparse_ternary(a) or is_sparse_ternary(b)):
+        return "sparse"
+    n = max(len(a), len(b))
+    if n < FFT_MIN_N:
+        return "convolve"
+    if fft_exact(a, b):
+        return "fft"
+    if n > KARATSUBA_BASE:
+        return "karatsuba"
+    return "convolve"
+
+
+@metrics.timed("ring.fft_mul")
+def fft_mul(a, b):
+    """
+    Return the ordinary (non-cyclic) product of the polynomials a and b computed with a
+    real float64 FFT, rounded to the nearest integers. The result is only exact if
+    fft_exact(a, b) holds.
+
+    If a is a matrix every row is multiplied by b.
+    """
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    n = a.shape[-1] + b.shape[-1] - 1
+    L = 1 << (n - 1).bit_length()
+    c = np.fft.irfft(np.fft.rfft(a, L) * np.fft.rfft(b, L), L)[..., :n]
+    return np.rint(c).astype(np.int64)
+
+
+@metrics.timed("ring.karatsuba_mul")
+def karatsuba_mul(a, b):
+    """
+    Return the ordinary (non-cyclic) product of the polynomials a and b computed with
+    Karatsuba's method: splitting both into halves a = a0 + s a1, b = b0 + s b1 takes the
+    three products a0 b0, a1 b1 and (a0 + a1)(b0 + b1) instead of four.
+    """
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    n = len(a) + len(b) - 1
+    # Padding both at the end to the same length appends zeros to the product only
+    size = max(len(a), len(b))
+    return _karatsuba(np.pad(a, (0, size - len(a))), np.pad(b, (0, size - len(b))))[:n]
+
+
+def _karatsuba(a, b):
+    n = len(a)
+    if n <= KARATSUBA_BASE:
+        return np.convolve(a, b)
+    h = n // 2
+    low = _karatsuba(a[:h], b[:h])
+    high = _karatsuba(a[h:], b[h:])
+    a_sum = a[h:].copy()
+    a_sum[:h] += a[:h]
+    b_sum = b[h:].copy()
+    b_sum[:h] += b[:h]
+    mid = _karatsuba(a_sum, b_sum)
+    mid[:len(low)] -= low
+    mid -= high
+
+    out = np.zeros((2 * n - 1,), dtype=np.int64)
+    out[:len(low)] = low
+    out[2 * h:] += high
+    out[h:h + len(mid)] += mid
+    return out
+
+
+def _check_backend(backend, a, b):
+    if backend not in BACKENDS:
+        raise ValueError("Unknown multiplication backend {!r}, expected one of {}".format(backend, BACKENDS))
+    if backend == "fft" and not fft_exact(a, b):
+        raise ValueError("The fft backend is not exact for these operands")
+
+
+@metrics.timed("ring.linear_mul")
+def linear_mul(a, b, backend=None):
+    """
+    Return the ordinary (non-cyclic) product of the polynomials a and b.
+
+    The backend ("convolve", "karatsuba" or "fft") is chosen by select_backend unless given.
+    """
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    if backend is None:
+        backend = select_backend(a, b, cyclic=False)
+    elif backend == "sparse":
+        raise ValueError("The sparse backend only computes cyclic products")
+    else:
+        _check_backend(backend, a, b)
+    return _linear(a, b, backend)
+
+
+def _linear(a, b, backend):
+    if backend == "fft":
+        return fft_mul(a, b)
+    if backend == "karatsuba":
+        return karatsuba_mul(a, b)
+    return np.convolve(a, b)
+
+
+@metrics.timed("ring.cyclic_mul")
+def cyclic_mul(a, b, N, backend=None):
+    """
+    Multiply the polynomials a and b in Z[x]/(x^N - 1).
+
+    INPUTS:
+    =======
+    a, b    : Integer arrays of at most N coefficients.
+    N       : Integer, order of the polynomial ring.
+    backend : Name of the multiplication backend (see BACKENDS), by default the one chosen
+              by select_backend.
+
+    RETURNS:
+    ========
+    An int64 array of N coefficients, no modular reduction is applied to them.
+
+    NOTE : If a or b is a sparse ternary polynomial (e.g. r, f or g) the product is computed
+           with sparse_mul, at a cost proportional to its weight instead of N^2. Dense
+           products of large polynomials use an FFT whenever that is provably exact.
+           Ternary polynomials packed to 2 bits (compact.PackedTernary) are passed to
+           sparse_mul without unpacking them to int64.
+    """
+    if backend in (None, "sparse"):
+        if hasattr(b, "indices"):
+            a, b = b, a
+        if hasattr(a, "indices"):
+            return sparse_mul(*a.indices(), b, N)
+    a = to_ring(a, N)
+    b = to_ring(b, N)
+    if backend is None:
+        backend = select_backend(a, b)
+    else:
+        _check_backend(backend, a, b)
+    if backend == "sparse":
+        # Any ternary operand will do, the density only matters to select_backend
+        if not is_ternary(a) or (is_ternary(b) and np.count_nonzero(b) < np.count_nonzero(a)):
+            a, b = b, a
+        if not is_ternary(a):
+            raise ValueError("The sparse backend needs a ternary operand")
+        return sparse_mul(*ternary_indices(a), b, N)
+    return fold(_linear(a, b, backend), N)
+
+
+@metrics.timed("ring.circulant")
+def circulant(b, N, amax=None):
+    """
+    Return the N x N matrix C of the polynomial b, such that for a row vector a of N
+    coefficients a @ C is the product a * b in Z[x]/(x^N - 1).
+
+    If amax, the largest absolute coefficient of the rows it will be multiplied with, is
+    given the matrix is returned as float32 or float64 when that keeps every product exact
+    (no partial sum can exceed 2^24 or 2^53 respectively), so that circulant_mul runs on BLAS.
+    """
+    b = to_ring(b, N)
+    C = b[rotation_index(N)]
+    if amax is not None:
+        bound = N * int(amax) * int(np.abs(b).max(initial=0))
+        if bound < 2 ** 24:
+            return C.astype(np.float32)
+        if bound < 2 ** 53:
+            return C.astype(np.float64)
+    return C
+
+
+@metrics.timed("ring.circulant_mul")
+def circulant_mul(A, C):
+    """
+    Multiply every row of the matrix A by the polynomial whose circulant matrix (see
+    circulant) is C.
+
+    RETURNS:
+    ========
+    An int64 array of shape (k, N), no modular reduction is applied to it.
+    """
+    if C.dtype.kind == "f":
+        return np.rint(np.asarray(A, dtype=C.dtype) @ C).astype(np.int64)
+    return np.asarray(A, dtype=np.int64) @ C
+
+
+def is_ternary(a):
+    """
+    Return True if all coefficients of a are in {-1, 0, 1}.
+    """
+    return np.abs(a).max(initial=0) <= 1
+
+
+def is_sparse_ternary(a):
+    """
+    Return True if all coefficients of a are in {-1, 0, 1} and few enough of them are
+    non-zero for sparse_mul to beat a dense convolution.
+    """
+    return np.count_nonzero(a) <= SPARSE_DENSITY * len(a) and is_ternary(a)
+
+
+def ternary_indices(a):
+    """
+    Return the sparse form of the ternary polynomial a as a pair of index arrays
+    (positions of the +1 coefficients, positions of the -1 coefficients).
+    """
+    return np.flatnonzero(a == 1), np.flatnonzero(a == -1)
+
+
+@metrics.timed("ring.sparse_mul")
+def sparse_mul(plus, minus, b, N):
+    """
+    Multiply the ternary polynomial given in sparse form by the dense polynomial b in
+    Z[x]/(x^N - 1).
+
+    Every +1 (-1) coefficient at position i of the ternary operand stands for the monomial
+    x^(N-1-i), so the product is the sum (difference) of the matching cyclic rotations of b.
+
+    INPUTS:
+    =======
+    plus, minus : Integer arrays, positions of the +1 and -1 coefficients (see ternary_indices).
+    b           : Integer array of at most N coefficients.
+    N           : Integer, order of the polynomial ring.
+
+    RETURNS:
+    ========
+    An int64 array of N coefficients, no modular reduction is applied to them.
+    """
+    b = to_ring(b, N)
+    # Row N-1-i of the window view over b twice is b rotated by x^(N-1-i)
+    rotations = sliding_window_view(np.concatenate((b, b)), N)
+    return rotations[N - 1 - np.asarray(plus)].sum(axis=0) - rotations[N - 1 - np.asarray(minus)].sum(axis=0)
+
+
+def reduce_mod(a, m):
+    """
+    Reduce all coefficients of a into [0, m).
+    """
+    a = np.asarray(a)
+    if a.dtype.kind in "iu" and is_pow2(m):
+        # Two's complement: the low bits are the residue mod m, also for negative values
+        return np.bitwise_and(a, m - 1)
+    return np.mod(a, m)
+
+
+def center_lift(a, m):
+    """
+    Reduce all coefficients of a modulo m into the centered range used by sympy's
+    Poly.trunc(m), i.e. a value c is kept if c mod m <= m // 2 and mapped to
+    (c mod m) - m otherwise.
+    """
+    # Shifting by the magnitude of the lowest value kept maps the centered range onto [0, m),
+    # in int64 so that compact inputs (see compact.py) cannot overflow
+    low = m - m // 2 - 1
+    c = np.add(a, low, dtype=np.int64)
+    if is_pow2(m):
+        # Two's complement: the low bits are the residue mod m, also for negative values
+        np.bitwise_and(c, m - 1, out=c)
+    else:
+        np.mod(c, m, out=c)
+    c -= low
+    return c
+
+
+def _trim(a):
+    """
+    Drop the zero coefficients of highest degree from an ascending coefficient array.
+    """
+    nz = np.flatnonzero(a)
+    return a[:nz[-1] + 1] if len(nz) else a[:0]
+
+
+@metrics.timed("ring.inverse_mod_prime")
+def inverse_mod_prime(a, N, p):
+    """
+    Find the inverse of the polynomial a in (Z/p)[x]/(x^N - 1) for a prime p using the
+    extended Euclidean algorithm on integer arrays.
+
+    RETURNS:
+    ========
+    The inverse as an int64 array of N coefficients in [0, p), or None if a is not
+    invertible.
+    """
+    a = np.mod(to_ring(a, N), p)
+    # x - 1 divides x^N - 1, so a(1) = 0 mod p is a cheap proof that no inverse exists
+    if a.sum() % p == 0:
+        return None
+
+    # The remainders r and the Bezout coefficients s (with s*a = r mod x^N - 1) are kept
+    # in ascending order, so that trimming and long division work from the array end
+    r0 = np.zeros((N + 1,), dtype=np.int64)
+    r0[0] = p - 1
+    r0[N] = 1
+    r1 = _trim(a[::-1].copy())
+    s0 = np.zeros((1,), dtype=np.int64)
+    s1 = np.ones((1,), dtype=np.int64)
+
+    while len(r1) > 1:
+        lead_inv = pow(int(r1[-1]), -1, p)
+        n1 = len(r1)
+        rem = r0.copy()
+        quot = np.zeros((len(r0) - n1 + 1,), dtype=np.int64)
+        for k in range(len(r0) - n1, -1, -1):
+            c = rem[k + n1 - 1] * lead_inv % p
+            if c:
+                quot[k] = c
+                rem[k:k + n1] = np.mod(rem[k:k + n1] - c * r1, p)
+        s_next = np.convolve(quot, s1)
+        s_next[:len(s0)] -= s0
+        r0, r1 = r1, _trim(rem[:n1 - 1])
+        s0, s1 = s1, _trim(np.mod(-s_next, p))
+
+    if len(r1) == 0:
+        # The last non-zero remainder (the gcd) is not a constant
+        return None
+
+    inv = np.mod(s1 * pow(int(r1[0]), -1, p), p)
+    return to_ring(inv[::-1], N)
+
+
+@metrics.timed("ring.inverse_mod_pow2")
+def inverse_mod_pow2(a, N, q):
+    """
+    Find the inverse of the polynomial a in (Z/q)[x]/(x^N - 1) for q a power of two.
+
+    The inverse is found mod 2 and then lifted with the Newton iteration
+        b -> b * (2 - a * b)
+    which doubles the number of correct bits in every step, see
+    https://arxiv.org/abs/1311.1779
+
+    RETURNS:
+    ========
+    The inverse as an int64 array of N coefficients in [0, q), or None if a is not
+    invertible.
+    """
+    b = inverse_mod_prime(a, N, 2)
+    if b is None:
+        return None
+
+    mod = 2
+    while mod < q:
+        mod = min(mod * mod, q)
+        t = np.mod(-cyclic_mul(a, b, N), mod)
+        t[-1] += 2
+        b = np.mod(cyclic_mul(b, t, N), mod)
+    return b
@@ -0,0 +1,81 @@
+"""
+Vectorised sampling of fixed-weight ternary polynomials (the f, g and r polynomials of NTRU).
+
+A random source (the rng argument) can be
+    None                       : the global numpy random state (np.random.seed applies)
+    numpy.random.Generator     : used as is
+    Integer or SeedSequence    : seeds a new numpy.random.Generator
+    "os"                       : the operating system entropy source (os.urandom)
+"""
+import os
+
+import numpy as np
+
+
+class OSEntropy:
+    """
+    Random source reading directly from os.urandom.
+    """
+
+    def integers64(self, shape):
+        n = int(np.prod(shape))
+        return np.frombuffer(os.urandom(8 * n), dtype=np.uint64).reshape(shape)
+
+
+def get_rng(rng=None):
+    """
+    Turn the rng argument accepted by the functions in this module into a random source.
+    """
+    if rng is None or isinstance(rng, (np.random.Generator, OSEntropy)):
+        return rng
+    if isinstance(rng, str):
+        if rng != "os":
+            raise ValueError("Unknown random source {}".format(rng))
+        return OSEntropy()
+    return np.random.default_rng(rng)
+
+
+def _sort_keys(rng, shape):
+    """
+    Draw independent random sort keys, argsort of a row gives a uniform random permutation.
+    """
+    rng = get_rng(rng)
+    if rng is None:
+        return np.random.random(shape)
+    if isinstance(rng, OSEntropy):
+        return rng.integers64(shape)
+    return rng.random(shape)
+
+
+def ternary(K, N, P, M, rng=None, sparse=False):
+    """
+    Draw K ternary polynomials of N coefficients, each with exactly P coefficients +1,
+    M coefficients -1 and the remaining coefficients 0, at uniformly random positions.
+
+    INPUTS:
+    =======
+    K      : Integer, the number of polynomials to draw.
+    N      : Integer, the number of coefficients of each polynomial.
+    P      : Integer, the number of +1 coefficients.
+    M      : Integer, the number of -1 coefficients.
+    rng    : Random source, see the module documentation.
+    sparse : Boolean, return the index form instead of the coefficients.
+
+    RETURNS:
+    ========
+    An integer array of shape (K, N), or if sparse is True a pair of integer arrays of shape
+    (K, P) and (K, M) with the positions of the +1 and -1 coefficients of every polynomial
+    (the per-row form of ring.ternary_indices).
+    """
+    if P + M > N:
+        raise ValueError("Asking for P+M>N")
+
+    order = np.argsort(_sort_keys(rng, (K, N)), axis=1)
+    if sparse:
+        return order[:, :P], order[:, P:P + M]
+
+    R = np.zeros((K, N), dtype=np.int8)
+    rows = np.arange(K)[:, None]
+    R[rows, order[:, :P]] = 1
+    R[rows, order[:, P:P + M]] = -1
+    return R
@@ -0,0 +1,153 @@
+"""
+Streaming encryption and decryption with bounded memory.
+
+The input is consumed in chunks of a fixed size and every chunk is encrypted into its own
+packed ciphertext frame (see codec.py). Frames carry their size in the header, so an
+encrypted stream is simply the concatenation of its frames and can be decrypted frame by
+frame as well. Peak memory depends on the chunk size only, not on the size of the input.
+"""
+import codec
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _reader(src):
+    """
+    Return a function read(n) returning up to n bytes from src, which is either a binary
+    file-like object or an iterable of bytes chunks.
+    """
+    if hasattr(src, "read"):
+        return src.read
+
+    chunks = iter(src)
+    buf = bytearray()
+
+    def read(n):
+        while len(buf) < n:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            buf.extend(chunk)
+        out = bytes(buf[:n])
+        del buf[:n]
+        return out
+
+    return read
+
+
+def _read_exact(read, n):
+    """
+    Read exactly n bytes (fewer only at the end of the stream).
+    """
+    parts = []
+    while n > 0:
+        part = read(n)
+        if not part:
+            break
+        parts.append(part)
+        n -= len(part)
+    return b"".join(parts)
+
+
+class StreamEncryptor:
+    """
+    Encrypt a stream of bytes into a stream of packed ciphertext frames.
+    """
+
+    def __init__(self, encryptor, chunk_size=CHUNK_SIZE, encoding=codec.ENCODING_BITS):
+        """
+        INPUTS:
+        =======
+        encryptor  : NTRUencrypt object with the public key read.
+        chunk_size : Integer, number of plaintext bytes encrypted per frame.
+        encoding   : Integer, the message encoding (codec.ENCODING_BITS or ENCODING_TERNARY).
+        """
+        if not encryptor.readKey:
+            raise ValueError("Public key not read before streaming encryption")
+        if encoding == codec.ENCODING_TERNARY and encryptor.p < 3:
+            raise ValueError("Ternary message encoding needs p >= 3")
+        self.encryptor = encryptor
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+
+    def encrypt_chunk(self, data):
+        """
+        Encrypt a single chunk of bytes into one ciphertext frame.
+        """
+        E = self.encryptor
+        B = codec.bytes_to_blocks(data, E.N, self.encoding)
+        return codec.pack_ciphertext(E.encryptBlocks(B), E.q, len(data), self.encoding)
+
+    def iter_encrypt(self, src):
+        """
+        Generator yielding the ciphertext frames for src, a binary file-like object or an
+        iterable of bytes chunks.
+        """
+        read = _reader(src)
+        while True:
+            data = _read_exact(read, self.chunk_size)
+            if not data:
+                break
+            yield self.encrypt_chunk(data)
+
+    def encrypt_file(self, src, dst):
+        """
+        Encrypt src into the binary file-like object dst.
+        Return the number of ciphertext bytes written.
+        """
+        written = 0
+        for frame in self.iter_encrypt(src):
+            dst.write(frame)
+            written += len(frame)
+        return written
+
+
+class StreamDecryptor:
+    """
+    Decrypt a stream of packed ciphertext frames back into the plaintext bytes.
+    """
+
+    def __init__(self, decryptor):
+        """
+        INPUTS:
+        =======
+        decryptor : NTRUdecrypt object with the private key read.
+        """
+        self.decryptor = decryptor
+
+    def decrypt_frame(self, frame):
+        """
+        Decrypt a single ciphertext frame into its plaintext chunk.
+        """
+        D = self.decryptor
+        header, blocks = codec.unpack_ciphertext(frame)
+        if (header["N"], header["q"]) != (D.N, D.q):
+            raise ValueError("Ciphertext parameters N={}, q={} do not match the key".format(header["N"], header["q"]))
+        return codec.blocks_to_bytes(D.decryptBlocks(blocks), header["length"], header["encoding"])
+
+    def iter_decrypt(self, src):
+        """
+        Generator yielding the plaintext chunks for src, a binary file-like object or an
+        iterable of bytes chunks holding ciphertext frames.
+        """
+        read = _reader(src)
+        while True:
+            head = _read_exact(read, codec.HEADER.itemsize)
+            if not head:
+                break
+            header = codec.read_header(head)
+            body = _read_exact(read, codec.packed_size(header) - len(head))
+            if len(head) + len(body) < codec.packed_size(header):
+                raise ValueError("Ciphertext stream ends inside a frame")
+            yield self.decrypt_frame(head + body)
+
+    def decrypt_file(self, src, dst):
+        """
+        Decrypt src into the binary file-like object dst.
+        Return the number of plaintext bytes written.
+        """
+        written = 0
+        for data in self.iter_decrypt(src):
+            dst.write(data)
+            written += len(data)
+        return written
@@ -1,14 +1,7 @@
-import logging
-import math
-import time
-
 import numpy as np
-from math import log
 import sys
-# Use sympy for polynomial operations
-from sympy import Poly, symbols, GF, invert
-
-np.set_printoptions(threshold=sys.maxsize)
+import sampler
+from ring import cyclic_mul, inverse_mod_prime, inverse_mod_pow2, is_prime, is_pow2
 
 
 def factor_int(n):
@@ -38,29 +31,23 @@ def factor_int(n):
 
 
 def checkPrime(P):
-    a = time.time()
     """
     Check if the input integer P is prime, if prime return True
     else return False.
+    The trial division (from 2 up to sqrt(P)) runs once per value, results are cached.
     """
-    if P <= 1:
-        return False
-    elif P == 2 or P == 3:
-        return True
-    else:
-        # Otherwise, check if P is dividable by any value over 4 and under P/2
-        for i in range(4, P // 2):
-            if P % i == 0:
-                return False
+    return is_prime(P)
 
-    return True
 
-
-def poly_inv(poly_in,poly_I,poly_mod):
+def poly_inv(poly_in,poly_I,poly_mod,ctx=None):
     """
     Find the inverse of the polynomial poly_in in the Galois filed GF(poly_mod)
     i.e. the inverse in
         Z/poly_mod[X]/poly_I
+    where poly_I is the ring ideal x^N - 1.
+
+    If the RingContext ctx of the ring is given (poly_mod must then be its p or q), the
+    properties of poly_mod are taken from it rather than tested on every call.
 
     Inputs and outputs are given as an array of coefficients where
         x^4 + 5x^2 + 3 == [1,0,5,0,3]
@@ -74,89 +61,30 @@ def poly_inv(poly_in,poly_I,poly_mod):
     ==========
     https://arxiv.org/abs/1311.1779
     """
-    x = symbols('x')
-    Ppoly_I = Poly(poly_I,x)
-    Npoly_I = len(Ppoly_I.all_coeffs())
-    if checkPrime(poly_mod):
-        # For prime poly_mod we only need use the sympy invert routine, we then pull out
-        # all the coefficients for the inverse and return (not all_coeffs() also includes
-        # zeros in the array
-        try:
-            inv = invert(Poly(poly_in,x).as_expr(),Ppoly_I.as_expr(),domain=GF(poly_mod,symmetric=False))
-        except:
-            return np.array([])
-    elif log(poly_mod, 2).is_integer():
-        try:
-            # Follow the procedure outlined in https://arxiv.org/abs/1311.1779 to find the inverse
-            inv = invert(Poly(poly_in,x).as_expr(),Ppoly_I.as_expr(),domain=GF(2,symmetric=False))
-
-            ex = int(log(poly_mod,2))
-            for a in range(1,ex):
-                inv = ((2*Poly(inv,x)-Poly(poly_in,x)*Poly(inv,x)**2)%Ppoly_I).trunc(poly_mod)
-            inv = Poly(inv,domain=GF(poly_mod,symmetric=False))
-        except:
-            return np.array([])
+    N = len(poly_I) - 1
+    if ctx is not None:
+        prime, mask = ctx.modulus(poly_mod)
+    else:
+        prime, mask = checkPrime(poly_mod), (poly_mod - 1 if is_pow2(poly_mod) else None)
+    if prime:
+        # For prime poly_mod a single extended Euclid run over GF(poly_mod) is enough
+        inv = inverse_mod_prime(poly_in, N, poly_mod)
+    elif mask is not None:
+        # Invert over GF(2) and Newton-lift the result to poly_mod
+        inv = inverse_mod_pow2(poly_in, N, poly_mod)
     else:
         # Otherwise we cannot find the inverse
         return np.array([])
 
-    # If we have got this far we have calculated an inverse, doublecheck the inverse via poly mult
-    tmpCheck = np.array(Poly((Poly(inv,x)*Poly(poly_in,x))%Ppoly_I, domain=GF(poly_mod,symmetric=False)).all_coeffs(),dtype=int)
-    if len(tmpCheck)>1 or tmpCheck[0]!=1:
-        sys.exit("ERROR : Error in caclualtion of polynomial inverse")
-
-    return padArr(np.array(Poly(inv,x).all_coeffs(),dtype=int),Npoly_I-1)
-
-
-def poly_inv_2(poly_in, poly_I, poly_mod):
-    x = symbols('x')
-    Ppoly_I = Poly(poly_I, x)
-    Npoly_I = len(Ppoly_I.all_coeffs())
-
-    # Pre-compute domain
-    if checkPrime(poly_mod):
-        domain = GF(poly_mod, symmetric=False)
-    elif log(poly_mod, 2).is_integer():
-        domain = GF(2, symmetric=False)
-    else:
+    if inv is None:
         return np.array([])
 
-    # Convert input polynomial once
-    poly_in_expr = Poly(poly_in, x).as_expr()
-    poly_I_expr = Ppoly_I.as_expr()
-
-    try:
-        if checkPrime(poly_mod):
-            inv = invert(poly_in_expr, poly_I_expr, domain=domain)
-        else:  # Power of 2 case
-            inv = invert(poly_in_expr, poly_I_expr, domain=domain)
-
-
-            # Optimize the iteration loop
-            inv_poly = Poly(inv, x)
-            poly_in_poly = Poly(poly_in, x)
-
-            result = inv_poly
-            exponent = int(log(poly_mod, 2))
-
-            while exponent > 0:
-                if exponent % 2 == 1:  # wenn exponent ungerade ist
-                    result = ((2 * result - poly_in_poly * (result ** 2)) % Ppoly_I).trunc(poly_mod)
-                inv_poly = (inv_poly ** 2) % Ppoly_I  # Quadrat des aktuellen inversen Polynoms
-                exponent //= 2  # halbiere den Exponenten
-
-            inv = result
-    except:
-        return np.array([])
-
-    # Verification step
-    result_poly = Poly((Poly(inv, x) * Poly(poly_in, x)) % Ppoly_I, domain=domain)
-    tmpCheck = np.array(result_poly.all_coeffs(), dtype=int)
-
-    if len(tmpCheck) > 1 or tmpCheck[0] != 1:
-        raise ValueError("Error in calculation of polynomial inverse")
+    # If we have got this far we have calculated an inverse, doublecheck the inverse via poly mult
+    tmpCheck = np.mod(cyclic_mul(poly_in, inv, N), poly_mod)
+    if tmpCheck[-1] != 1 or np.any(tmpCheck[:-1]):
+        sys.exit("ERROR : Error in caclualtion of polynomial inverse")
 
-    return padArr(np.array(Poly(inv, x).all_coeffs(), dtype=int), Npoly_I - 1)
+    return inv
 
 
 def padArr(A_in, A_out_size):
@@ -170,7 +98,8 @@ def padArr(A_in, A_out_size):
 def genRand10(L, P, M):
     """
     Generate a numpy array of length L with P 1's, M -1's and the remaining elements 0.
-    The elements will be in a random order, with randomisation done using np.random.shuffle.
+    The elements will be in a random order, drawn from the global numpy random state
+    (see sampler.ternary for drawing many arrays at once and other random sources).
     This is used to generate the f, p and r arrays for NTRU encryption based on [1].
 
     INPUTS:
@@ -193,21 +122,7 @@ def genRand10(L, P, M):
     if P + M > L:
         sys.exit("ERROR: Asking for P+M>L.")
 
-    # Generate an `empty' array of zeros
-    R = np.zeros((L,), dtype=int)
-
-    # Loop through and populate the array with 1's and -1's, not in random order
-    for i in range(L):
-        if i < P:
-            R[i] = 1
-        elif i < P + M:
-            R[i] = -1
-        else:
-            break
-
-    # Return a randomised array
-    np.random.shuffle(R)
-    return R
+    return sampler.ternary(1, L, P, M)[0]
 
 
 def arr2str(ar):
@@ -222,15 +137,7 @@ def arr2str(ar):
     ========
     A string containing all the elements of ar concatenated, each element separated by a space
     """
-    st = np.array_str(ar)
-    st = st.replace("[", "", 1)
-    st = st.replace("]", "", 1)
-    st = st.replace("\n", "")
-    st = st.replace("     ", " ")
-    st = st.replace("    ", " ")
-    st = st.replace("   ", " ")
-    st = st.replace("  ", " ")
-    return st
+    return " ".join(map(str, np.asarray(ar).ravel().tolist()))
 
 
 def str2bit(st):
@@ -245,9 +152,12 @@ def str2bit(st):
     RETURNS:
     ========
     A numpy array containing only 1's and 0's representing the input string st in binary.
-    NOTE : The initial "0b" is removed from the output array.
+    NOTE : Leading zero bits are removed (as by bin()), see codec.encode_message for a
+           framed encoding that keeps them.
     """
-    return np.array(list(bin(int.from_bytes(str(st).encode(), "big")))[2:], dtype=int)
+    bits = np.unpackbits(np.frombuffer(str(st).encode(), dtype=np.uint8)).astype(int)
+    nz = np.flatnonzero(bits)
+    return bits[nz[0]:] if len(nz) else np.zeros((1,), dtype=int)
 
 
 def bit2str(bi):
@@ -263,27 +173,8 @@ def bit2str(bi):
     ========
     A string, the binary values in the bi array converted to a string.
     """
-
-    # Make sure the number of bits in the string is dividable by 8 (8 bits per character)
-    # S = padArr(bi, len(bi) + np.mod(len(bi), 8))
-
-    # Convert the input binary array to a string and remove any spaces
-    S = arr2str(bi)
-    S = S.replace(" ", "")
-
-    print(S)
-
-    # Then take each 8 bit section on its own, starting from last bits (to avoid issues
-    # that can arise from padding the front of the array with 0's)
-    charOut = ""
-    for i in range(len(S) // 8):
-        if i == 0:
-            charb = S[len(S) - 8:]
-        else:
-            charb = S[-(i + 1) * 8:-i * 8]
-
-        print(charb)
-        charb = int(charb, 2)
-        charOut = charb.to_bytes((charb.bit_length() + 7) // 8, "big").decode("utf-8", errors="ignore") + charOut
-
-    return charOut
+    # Group the bits into bytes counted from the end of the array (to avoid issues that
+    # can arise from padding the front of the array with 0's), zero bytes are dropped
+    bi = np.asarray(bi).ravel()
+    bi = np.pad(bi, (-len(bi) % 8, 0), constant_values=0)
+    return np.packbits(bi.astype(np.uint8)).tobytes().replace(b"\x00", b"").decode("utf-8", errors="ignore")